@@ -26,6 +26,10 @@ class Configuration(BaseSettings):
     tz = timezone("UTC")
     request_timeout = 30
 
+    # Any hashlib algorithm. url_hash is published in the feeds, so changing it
+    # changes the id of every article.
+    url_hash_algorithm: str = "sha256"
+
     output_feed_path: Path = Field(default=Path(__file__).parent / "output/feed")
     output_path: Path = Field(default=Path(__file__).parent / "output")
     wasm_thumbnail_path: Path = Field(
@@ -36,6 +40,9 @@ class Configuration(BaseSettings):
     # Set the number of processes to spawn for all multiprocessing tasks.
     concurrency = cpu_count()
     thread_pool_size = cpu_count() * 10
+    # Max in-flight requests for the asyncio based downloads.
+    async_concurrency = 200
+    async_concurrency_per_host = 8
 
     # Disable uploads and downloads to S3. Useful when running locally or in CI.
     no_upload: Optional[str] = None
@@ -59,6 +66,8 @@ class Configuration(BaseSettings):
     favicon_lookup_file: Path = Field(default="favicon_lookup.json")
     cover_info_lookup_file: Path = Field(default="cover_info_lookup.json")
     cover_info_cache_dir: Path = Field(default="cover_info_cache")
+    # Least recently used icons are evicted once the cache grows past this.
+    cover_info_cache_max_bytes: int = 5 * 1024 * 1024 * 1024
     tests_dir: Path = Field(default=Path(__file__).parent / "tests")
 
     sentry_url: str = ""
@@ -3,17 +3,60 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at https://mozilla.org/MPL/2.0/. */
 
+import re
 from typing import Any, Callable, Optional
 
+import nh3
+from bleach.html5lib_shim import HTML_TAGS_BLOCK_LEVEL
+from bleach.sanitizer import ALLOWED_ATTRIBUTES, ALLOWED_PROTOCOLS, ALLOWED_TAGS
 from orjson import orjson
 from pydantic import BaseModel
 
+# nh3 keeps the allowlist bleach.clean(v, strip=True) used, but is much faster.
+allowed_tags = set(ALLOWED_TAGS)
+allowed_attributes = {tag: set(attrs) for tag, attrs in ALLOWED_ATTRIBUTES.items()}
+allowed_url_schemes = set(ALLOWED_PROTOCOLS)
+
+# bleach turned a stripped block level start tag into a newline, unless no other
+# tag came before it.
+any_tag_re = re.compile(r"</?[a-zA-Z]")
+stripped_block_tags_re = re.compile(
+    r"<(?:%s)(?=[\s/>])" % "|".join(sorted(HTML_TAGS_BLOCK_LEVEL - allowed_tags)),
+    re.IGNORECASE,
+)
+
+
+def add_block_newlines(v: str) -> str:
+    first_tag = any_tag_re.search(v)
+    if first_tag is None:
+        return v
+    start = first_tag.start() + 1
+    return v[:start] + stripped_block_tags_re.sub("\n\\g<0>", v[start:])
+
 
 def orjson_dumps(v, *, default):
     # orjson.dumps returns bytes, to match standard json.dumps we need to decode
     return orjson.dumps(v, default=default).decode()
 
 
+def clean_str(v: str) -> str:
+    """Sanitizes v like bleach.clean(v, strip=True) did, except that character
+    references are decoded, e.g. &copy; comes out as ©."""
+    cleaned = nh3.clean(
+        add_block_newlines(v),
+        tags=allowed_tags,
+        attributes=allowed_attributes,
+        url_schemes=allowed_url_schemes,
+        link_rel=None,
+        # bleach kept the text of a stripped <script> or <style>, escaped.
+        clean_content_tags=set(),
+    )
+    # bleach left non-breaking spaces as they were, but html5ever writes them out
+    # as &nbsp;.
+    cleaned = cleaned.replace("&nbsp;", "\xa0")
+    return cleaned.replace("&amp;", "&")  # we want & left as is in the text
+
+
 class Model(BaseModel):
     """
     To find all the configuration options for a model, just visit the link below
@@ -6,10 +6,9 @@
 from datetime import datetime
 from typing import Any, Optional
 
-import bleach
 from pydantic import HttpUrl, root_validator
 
-from models.base import Model
+from models.base import Model, clean_str
 
 
 class FeedBase(Model):
@@ -31,8 +30,6 @@ class FeedBase(Model):
     def bleach_each_value(cls, values: dict) -> dict[str, Any]:
         for k, v in values.items():
             if isinstance(v, str):
-                values[k] = bleach.clean(v, strip=True).replace(
-                    "&amp;", "&"
-                )  # workaround limitation in bleach
+                values[k] = clean_str(v)
 
         return values
@@ -6,10 +6,9 @@
 import hashlib
 from typing import Any, Dict, List, Optional
 
-import bleach
 from pydantic import Field, HttpUrl, root_validator, validator
 
-from models.base import Model
+from models.base import Model, clean_str
 
 
 class PublisherBase(Model):
@@ -34,9 +33,7 @@ class PublisherBase(Model):
     def bleach_each_value(cls, values: dict) -> Dict[str, Any]:
         for k, v in values.items():
             if isinstance(v, str):
-                values[k] = bleach.clean(v, strip=True).replace(
-                    "&amp;", "&"
-                )  # workaround limitation in bleach
+                values[k] = clean_str(v)
 
         return values
 
@@ -100,5 +97,7 @@ class LocaleModel(Model):
         return v.split(";") if v else []
 
 
-class PublisherGlobal(PublisherBase):
+class PublisherGlobal(PublisherModel):
+    # channels and rank are validated here too, so the per-locale entry can be
+    # built with LocaleModel.construct() instead of validating the row twice.
     locales: list[LocaleModel] = []
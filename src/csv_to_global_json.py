@@ -4,7 +4,9 @@
 # You can obtain one at https://mozilla.org/MPL/2.0/. */
 
 import csv
-import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
 
 import structlog
 from orjson import orjson
@@ -17,38 +19,70 @@ from utils import get_cover_infos_lookup, get_favicons_lookup, upload_file
 config = get_config()
 logger = structlog.getLogger(__name__)
 
-locales_finder = re.compile(r"sources\.(.*)\.csv")
-
-favicons_lookup = get_favicons_lookup()
-cover_infos_lookup = get_cover_infos_lookup()
-
-publisher_include_keys = {
-    "enabled": True,
-    "publisher_name": True,
-    "category": True,
-    "site_url": True,
-    "feed_url": True,
-    "favicon_url": True,
-    "cover_url": True,
-    "background_color": True,
-    "score": True,
-    "destination_domains": True,
-    "locales": True,
-    "publisher_id": True,
-}
+# In the same order as the fields on PublisherGlobal, so the output matches what
+# pydantic's .dict(include=...) produced.
+publisher_include_keys = (
+    "enabled",
+    "publisher_name",
+    "category",
+    "site_url",
+    "feed_url",
+    "favicon_url",
+    "cover_url",
+    "background_color",
+    "score",
+    "destination_domains",
+    "publisher_id",
+)
+
+
+def publisher_to_dict(publisher: PublisherGlobal) -> dict:
+    """Serialize an already validated publisher without pydantic's export
+    machinery, which is needlessly slow for this fixed shape."""
+    data = {key: getattr(publisher, key) for key in publisher_include_keys}
+    data["locales"] = [locale.__dict__ for locale in publisher.locales]
+    return data
+
+
+def locale_of(source_file: Path) -> str:
+    """sources.en_US.csv ==> en_US"""
+    return source_file.stem.split(".", 1)[1]
+
+
+def parse_source_file(source_file: Path) -> List[Tuple[PublisherGlobal, LocaleModel]]:
+    """Validate every row of a locale's sources file. Files are independent, so
+    this runs in a worker process and the results are merged in main()."""
+    locale = locale_of(source_file)
+    rows = []
+    with open(source_file) as publisher_file_pointer:
+        publisher_reader = csv.DictReader(publisher_file_pointer)
+        for data in publisher_reader:
+            try:
+                publisher: PublisherGlobal = PublisherGlobal(**data)
+            except ValidationError as e:
+                logger.info(f"{e} on {data}")
+                continue
+
+            locale_builder = LocaleModel.construct(
+                locale=locale,
+                channels=publisher.channels,
+                rank=publisher.rank,
+            )
+            rows.append((publisher, locale_builder))
+
+    return rows
 
 
 def main():
+    favicons_lookup = get_favicons_lookup()
+    cover_infos_lookup = get_cover_infos_lookup()
+
     publishers = {}
-    source_files = config.sources_dir.glob("sources.*_*.csv")
-    for source_file in source_files:
-        locale = locales_finder.findall(source_file.name)[0]
-        with open(source_file) as publisher_file_pointer:
-            publisher_reader = csv.DictReader(publisher_file_pointer)
-            for data in publisher_reader:
+    source_files = sorted(config.sources_dir.glob("sources.*_*.csv"))
+    with ProcessPoolExecutor(config.concurrency) as executor:
+        for rows in executor.map(parse_source_file, source_files):
+            for publisher, locale_builder in rows:
                 try:
-                    publisher: PublisherGlobal = PublisherGlobal(**data)
-
                     if publisher.publisher_id not in publishers:
                         publisher.favicon_url = favicons_lookup.get(
                             publisher.site_url, None
@@ -60,24 +94,18 @@ def main():
                         publisher.cover_url = cover_info.get("cover_url")
                         publisher.background_color = cover_info.get("background_color")
 
-                        locale_builder = LocaleModel(**data)
-                        locale_builder.locale = locale
                         publisher.locales.append(locale_builder)
 
                         publishers[publisher.publisher_id] = publisher
 
                     else:
                         existing_publisher = publishers[publisher.publisher_id]
-                        locale_builder = LocaleModel(**data)
-                        locale_builder.locale = locale
                         existing_publisher.locales.append(locale_builder)
 
                 except ValidationError as e:
-                    logger.info(f"{e} on {data}")
+                    logger.info(f"{e} on {publisher.publisher_name}")
 
-    publishers_data_as_list = [
-        x.dict(include=publisher_include_keys) for x in publishers.values()
-    ]
+    publishers_data_as_list = [publisher_to_dict(x) for x in publishers.values()]
 
     publishers_data_as_list = sorted(
         publishers_data_as_list, key=lambda x: x["publisher_name"]
@@ -17,41 +17,45 @@ config = get_config()
 
 logger = structlog.getLogger(__name__)
 
-favicons_lookup = get_favicons_lookup()
-cover_infos_lookup = get_cover_infos_lookup()
-
-publisher_include_keys = {
-    "enabled": True,
-    "publisher_name": True,
-    "category": True,
-    "site_url": True,
-    "feed_url": True,
-    "favicon_url": True,
-    "cover_url": True,
-    "background_color": True,
-    "score": True,
-    "channels": True,
-    "rank": True,
-    "publisher_id": True,
-    "destination_domains": True,
-}
-
-feed_include_keys = {
-    "category": True,
-    "publisher_name": True,
-    "content_type": True,
-    "publisher_domain": True,
-    "publisher_id": True,
-    "max_entries": True,
-    "og_images": True,
-    "creative_instance_id": True,
-    "feed_url": True,
-    "site_url": True,
-    "destination_domains": True,
-}
+publisher_include_keys = frozenset(
+    {
+        "enabled",
+        "publisher_name",
+        "category",
+        "site_url",
+        "feed_url",
+        "favicon_url",
+        "cover_url",
+        "background_color",
+        "score",
+        "channels",
+        "rank",
+        "publisher_id",
+        "destination_domains",
+    }
+)
+
+feed_include_keys = frozenset(
+    {
+        "category",
+        "publisher_name",
+        "content_type",
+        "publisher_domain",
+        "publisher_id",
+        "max_entries",
+        "og_images",
+        "creative_instance_id",
+        "feed_url",
+        "site_url",
+        "destination_domains",
+    }
+)
 
 
 def main():
+    favicons_lookup = get_favicons_lookup()
+    cover_infos_lookup = get_cover_infos_lookup()
+
     publisher_file_path = f"{config.sources_dir / config.sources_file}.csv"
     publisher_output_path = "feed.json"
     publishers = []
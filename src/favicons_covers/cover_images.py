@@ -3,28 +3,29 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at https://mozilla.org/MPL/2.0/. */
 
-import json
+import io
 import os
+import threading
+import time
 import urllib
 from multiprocessing import Pool
 from multiprocessing.pool import ThreadPool
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import metadata_parser
-import requests
+import numpy as np
+import soupsieve
 import structlog
 from bs4 import BeautifulSoup
-from fake_useragent import UserAgent
 from orjson import orjson
 from PIL import Image
 from requests import HTTPError
 
 import image_processor_sandboxed
 from config import get_config
-from favicons_covers.color import color_length, hex_color, is_transparent
-from utils import get_all_domains, upload_file
+from favicons_covers.color import hex_color
+from utils import get_all_domains, get_http_session, get_user_agent, upload_file
 
-ua = UserAgent(browsers=["edge", "chrome", "firefox", "safari", "opera"])
 REQUEST_TIMEOUT = 15
 
 config = get_config()
@@ -37,13 +38,103 @@ im_proc = image_processor_sandboxed.ImageProcessor(
 
 CACHE_FOLDER = config.output_path / config.cover_info_cache_dir
 CACHE_FOLDER.mkdir(parents=True, exist_ok=True)
+CACHE_INDEX_FILE = CACHE_FOLDER / ".lru.json"
+
+MANIFEST_SELECTOR = soupsieve.compile('link[rel="manifest"]')
+ICON_SELECTOR = soupsieve.compile('link[rel="apple-touch-icon"], link[rel="icon"]')
+OPEN_GRAPH_SELECTOR = soupsieve.compile(
+    'meta[property="og:image"], meta[property="twitter:image"], meta[property="image"]'
+)
+
+# Decoded icons up to this many pixels are also cached as raw RGBA arrays, along
+# with the size of the source image, so later runs can skip decoding the image
+# again.
+MAX_DECODED_CACHE_PIXELS = 1024 * 1024
+
+# Downloads larger than this aren't treated as icons.
+MAX_ICON_BYTES = 10 * 1024 * 1024
+
+# Icons are only used for their edge colors, so they're decoded at this size at
+# most. Their source size is kept in image.info["source_size"] for ranking.
+ICON_SIZE = (256, 256)
+
+
+def load_cache_index() -> dict:
+    """Maps the name of every file in CACHE_FOLDER to [last access, size]. Caches
+    from before the index existed are picked up from the file system."""
+    try:
+        with open(CACHE_INDEX_FILE, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        pass
+
+    index = {}
+    for entry in os.scandir(CACHE_FOLDER):
+        if entry.is_file() and not entry.name.startswith("."):
+            stat = entry.stat()
+            index[entry.name] = [stat.st_atime, stat.st_size]
+    return index
+
+
+cache_lock = threading.Lock()
+cache_index = load_cache_index()
+cache_size = sum(size for _, size in cache_index.values())
+
+
+def touch_cache_entry(filename: str):
+    with cache_lock:
+        entry = cache_index.get(os.path.basename(filename))
+        if entry:
+            entry[0] = time.time()
+
+
+def add_cache_entry(filename: str):
+    global cache_size
+    name = os.path.basename(filename)
+    size = os.path.getsize(filename)
+    with cache_lock:
+        if name in cache_index:
+            cache_size -= cache_index[name][1]
+        cache_index[name] = [time.time(), size]
+        cache_size += size
+
+        if cache_size > config.cover_info_cache_max_bytes:
+            evict_cache_entries()
+
+
+def evict_cache_entries():
+    """Removes the least recently used files from the cache. Must be called with
+    cache_lock held."""
+    global cache_size
+    # Evict down to 90% of the cap, so we aren't sorting the index on every write.
+    target = config.cover_info_cache_max_bytes * 0.9
+    for name, (_, size) in sorted(cache_index.items(), key=lambda x: x[1][0]):
+        if cache_size <= target:
+            break
+        try:
+            os.remove(CACHE_FOLDER / name)
+        except FileNotFoundError:
+            pass
+        del cache_index[name]
+        cache_size -= size
+
+
+def save_cache_index():
+    with cache_lock:
+        data = orjson.dumps(cache_index)
+    with open(f"{CACHE_INDEX_FILE}.tmp", "wb") as f:
+        f.write(data)
+    os.replace(f"{CACHE_INDEX_FILE}.tmp", CACHE_INDEX_FILE)
 
 
 def get_soup(domain) -> Optional[BeautifulSoup]:
     try:
-        html = requests.get(
-            domain, timeout=config.request_timeout, headers={"User-Agent": ua.random}
-        ).content.decode("utf-8")
+        response = get_http_session().get(
+            domain,
+            timeout=config.request_timeout,
+            headers={"User-Agent": get_user_agent()},
+        )
+        html = response.content.decode("utf-8")
         return BeautifulSoup(html, features="lxml")
     # Failed to download html
     except Exception:
@@ -51,7 +142,7 @@ def get_soup(domain) -> Optional[BeautifulSoup]:
 
 
 def get_manifest_icon_urls(site_url: str, soup: BeautifulSoup):
-    manifest_rel = soup.select_one('link[rel="manifest"]')
+    manifest_rel = MANIFEST_SELECTOR.select_one(soup)
     if not manifest_rel:
         return []
 
@@ -62,16 +153,17 @@ def get_manifest_icon_urls(site_url: str, soup: BeautifulSoup):
     url = urllib.parse.urljoin(site_url, manifest_link)
 
     try:
-        manifest_response = requests.get(
-            url, timeout=config.request_timeout, headers={"User-Agent": ua.random}
+        manifest_response = get_http_session().get(
+            url,
+            timeout=config.request_timeout,
+            headers={"User-Agent": get_user_agent()},
         )
 
         if not manifest_response.ok:
             logger.info(f"Failed to download manifest from {url}")
             return []
 
-        content = manifest_response.content.decode("utf-8")
-        manifest_json = json.loads(content)
+        manifest_json = orjson.loads(manifest_response.content)
 
         if "icons" not in manifest_json:
             return []
@@ -85,21 +177,14 @@ def get_manifest_icon_urls(site_url: str, soup: BeautifulSoup):
 
 
 def get_apple_icon_urls(site_url: str, soup: BeautifulSoup):
-    image_rels = soup.select('link[rel="apple-touch-icon"]')
-    image_rels += soup.select('link[rel="icon"]')
-
-    for rel in image_rels:
+    for rel in ICON_SELECTOR.select(soup):
         if not rel.has_attr("href"):
             continue
         yield rel.attrs["href"]
 
 
 def get_open_graph_icon_urls(site_url: str, soup: BeautifulSoup):
-    image_metas = soup.select('meta[property="og:image"]')
-    image_metas += soup.select('meta[property="twitter:image"]')
-    image_metas += soup.select('meta[property="image"]')
-
-    for meta in image_metas:
+    for meta in OPEN_GRAPH_SELECTOR.select(soup):
         if not meta.has_attr("content"):
             continue
         yield meta.attrs["content"]
@@ -109,6 +194,48 @@ def get_filename(url: str):
     return os.path.join(CACHE_FOLDER, urllib.parse.quote_plus(url))
 
 
+def get_decoded_filename(filename: str):
+    return f"{filename}.rgba.npz"
+
+
+def save_decoded_icon(filename: str, image: Image):
+    width, height = image.size
+    if width * height > MAX_DECODED_CACHE_PIXELS:
+        return
+
+    # Write to a temporary file first, so an interrupted run can't leave a
+    # truncated array behind.
+    decoded_filename = get_decoded_filename(filename)
+    with open(f"{decoded_filename}.tmp", "wb") as f:
+        np.savez(f, pixels=np.asarray(image), source_size=image.info["source_size"])
+    os.replace(f"{decoded_filename}.tmp", decoded_filename)
+    add_cache_entry(decoded_filename)
+
+
+def download_icon(icon_url: str) -> Optional[io.BytesIO]:
+    with get_http_session().get(
+        icon_url,
+        stream=True,
+        timeout=config.request_timeout,
+        headers={"User-Agent": get_user_agent()},
+    ) as response:
+        if not response.ok:
+            return None
+
+        content_length = response.headers.get("Content-Length")
+        if content_length and int(content_length) > MAX_ICON_BYTES:
+            return None
+
+        buffer = io.BytesIO()
+        for chunk in response.iter_content(64 * 1024):
+            buffer.write(chunk)
+            if buffer.tell() > MAX_ICON_BYTES:
+                return None
+
+    buffer.seek(0)
+    return buffer
+
+
 def get_icon(icon_url: str) -> Image:
     filename = get_filename(icon_url)
     if filename.endswith(".svg"):
@@ -116,21 +243,45 @@ def get_icon(icon_url: str) -> Image:
         return None
 
     try:
-        if not os.path.exists(filename):
-            response = requests.get(
-                icon_url,
-                stream=True,
-                timeout=config.request_timeout,
-                headers={"User-Agent": ua.random},
-            )
-            if not response.ok:
+        decoded_filename = get_decoded_filename(filename)
+        if os.path.exists(decoded_filename):
+            touch_cache_entry(decoded_filename)
+            with np.load(decoded_filename) as decoded:
+                image = Image.fromarray(decoded["pixels"])
+                image.info["source_size"] = tuple(decoded["source_size"].tolist())
+            return image
+
+        buffer = None
+        if os.path.exists(filename):
+            touch_cache_entry(filename)
+            image = Image.open(filename)
+        else:
+            buffer = download_icon(icon_url)
+            if buffer is None:
                 return None
+            image = Image.open(buffer)
 
+        source_size = image.size
+        if image.format == "JPEG":
+            # Lets libjpeg decode at a reduced scale.
+            image.draft("RGB", ICON_SIZE)
+        else:
+            # Resizing can't handle every mode (e.g. I;16), and palette images
+            # would only be resized with the nearest neighbour.
+            image = image.convert("RGBA")
+        image.thumbnail(ICON_SIZE, Image.LANCZOS)
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        image.info["source_size"] = source_size
+
+        # Only cache downloads that turned out to be valid images.
+        if buffer is not None:
             with open(filename, "wb") as f:
-                for chunk in response.iter_content(1024):
-                    f.write(chunk)
+                f.write(buffer.getbuffer())
+            add_cache_entry(filename)
 
-        return Image.open(filename).convert("RGBA")
+        save_decoded_icon(filename, image)
+        return image
 
     # Failed to download the image, or the thing we downloaded wasn't valid.
     except Exception:
@@ -153,28 +304,44 @@ def get_best_image(site_url: str) -> Optional[tuple[Image, str]]:
         icons = filter(
             lambda x: x[0] is not None, [(get_icon(url), url) for url in icon_urls]
         )
-        icons = list(reversed(sorted(icons, key=lambda x: min(x[0].size))))
+        # Rank by the size of the source image, the decoded ones are capped at
+        # ICON_SIZE.
+        icons = list(
+            reversed(sorted(icons, key=lambda x: min(x[0].info["source_size"])))
+        )
         if len(icons) != 0:
             return icons[0]
 
 
-def find_non_transparent(
-    image: Image, start: Tuple[int, int], step: Tuple[int, int], min_transparency=0.8
-):
-    width, height = image.size
-    x, y = start
-    step_x, step_y = step
-
-    while True:
-        color = image.getpixel((x, y))
-        if not is_transparent(color, min_transparency):
-            return color
-
-        x += step_x
-        y += step_y
-
-        if x < 0 or y < 0 or x >= width or y >= height:
-            return None
+def get_edge_colors(image: Image, min_transparency=0.8) -> np.ndarray:
+    """
+    Returns the first non transparent pixel found walking in from each edge,
+    for every row (left, right) and then every column (top, bottom).
+    """
+    pixels = np.asarray(image)
+    height, width = pixels.shape[:2]
+    opaque = pixels[..., 3] >= 255 * min_transparency
+    rows = np.arange(height)
+    columns = np.arange(width)
+
+    left = opaque.argmax(axis=1)
+    right = width - 1 - opaque[:, ::-1].argmax(axis=1)
+    top = opaque.argmax(axis=0)
+    bottom = height - 1 - opaque[::-1, :].argmax(axis=0)
+
+    # argmax returns 0 for rows/columns without any opaque pixel, so those
+    # are dropped with the masks below.
+    vertical = np.stack((pixels[rows, left], pixels[rows, right]), axis=1)
+    horizontal = np.stack((pixels[top, columns], pixels[bottom, columns]), axis=1)
+    vertical_mask = np.repeat(opaque.any(axis=1), 2)
+    horizontal_mask = np.repeat(opaque.any(axis=0), 2)
+
+    return np.concatenate(
+        (
+            vertical.reshape(-1, 4)[vertical_mask],
+            horizontal.reshape(-1, 4)[horizontal_mask],
+        )
+    )
 
 
 def get_background_color(image: Image):
@@ -184,31 +351,15 @@ def get_background_color(image: Image):
     the median edge color. That is, the middle most color of all
     the edge pixels in the image.
     """
-    width, height = image.size
-    colors = []
-
-    # add all the vertical edge pixels
-    for y in range(height):
-        left = find_non_transparent(image, (0, y), (1, 0))
-        right = find_non_transparent(image, (width - 1, y), (-1, 0))
-
-        colors.append(left)
-        colors.append(right)
-
-    # add all the horizontal edge pixels
-    for x in range(width):
-        top = find_non_transparent(image, (x, 0), (0, 1))
-        bottom = find_non_transparent(image, (x, height - 1), (0, -1))
-
-        colors.append(top)
-        colors.append(bottom)
-
-    colors = [color for color in colors if color is not None]
+    colors = get_edge_colors(image)
     if len(colors) == 0:
         return None
 
-    colors.sort(key=color_length)
-    color = colors[len(colors) // 2]
+    # The squared length orders colors the same way color_length does. The sort is
+    # stable, so colors of the same length keep their edge order and the pick
+    # is the same on every run.
+    lengths = (colors[:, :3].astype(np.int64) ** 2).sum(axis=1)
+    color = colors[np.argsort(lengths, kind="stable")[len(colors) // 2]]
     return hex_color(color)
 
 
@@ -221,8 +372,8 @@ def process_site(domain: str):  # noqa: C901
             f"https://t0.gstatic.com/faviconV2?client=SOCIAL&"
             f"type=FAVICON&fallback_opts=TYPE,SIZE,URL&url={domain}&size=256"
         )
-        res = requests.get(
-            image_url, timeout=REQUEST_TIMEOUT, headers={"User-Agent": ua.random}
+        res = get_http_session().get(
+            image_url, timeout=REQUEST_TIMEOUT, headers={"User-Agent": get_user_agent()}
         )
 
         res.raise_for_status()
@@ -244,7 +395,7 @@ def process_site(domain: str):  # noqa: C901
             page = metadata_parser.MetadataParser(
                 url=domain,
                 support_malformed=True,
-                url_headers={"User-Agent": ua.random},
+                url_headers={"User-Agent": get_user_agent()},
                 search_head_only=True,
                 strategy=["page", "meta", "og", "dc"],
                 requests_timeout=config.request_timeout,
@@ -270,54 +421,56 @@ def process_site(domain: str):  # noqa: C901
     return domain, image_url, background_color
 
 
-def process_cover_image(item):
-    domain = ""
-    padded_image_url = ""
-    background_color = ""
+def process_cover_image(image_url: str) -> Tuple[str, Optional[str]]:
     try:
-        domain, image_url, background_color = item
-        try:
-            cache_fn = im_proc.cache_image(image_url)
-        except Exception as e:
-            cache_fn = None
-            logger.error(f"im_proc.cache_image failed [{e}]: {image_url}")
-        if cache_fn:
-            padded_image_url = (
-                f"{config.pcdn_url_base}/brave-today/cover_images/{cache_fn}"
-            )
-        else:
-            padded_image_url = None
-
-    except ValueError as e:
-        logger.info(f"Tuple unpacking error {e}")
+        cache_fn = im_proc.cache_image(image_url)
+    except Exception as e:
+        cache_fn = None
+        logger.error(f"im_proc.cache_image failed [{e}]: {image_url}")
 
-    logger.info(
-        f"The padded image of the {domain} is {padded_image_url} with {background_color}"
-    )
+    if cache_fn:
+        padded_image_url = f"{config.pcdn_url_base}/brave-today/cover_images/{cache_fn}"
+    else:
+        padded_image_url = None
 
-    return domain, padded_image_url, background_color
+    return image_url, padded_image_url
 
 
 if __name__ == "__main__":
-    domains = list(set(get_all_domains()))
+    domains = list(get_all_domains())
     logger.info(f"Processing {len(domains)} domains")
 
-    cover_infos: List[Tuple[str, str, str]]
+    cover_infos: List[Tuple[str, str, str]] = []
 
     # This work is IO bound, so it's okay to start up a bunch more threads
-    # than we have cores, it just means we'll have more in flight requests.
+    # than we have cores, it just means we'll have more in flight requests. One
+    # domain at a time, so no domain waits behind a slow site.
     with ThreadPool(config.thread_pool_size) as pool:
-        cover_infos = list(
-            filter(lambda x: x is not None, pool.map(process_site, domains))
-        )
-
-    processed_cover_images: List[Tuple[str, str, str]]
+        for cover_info in pool.imap_unordered(process_site, domains):
+            if cover_info is not None:
+                cover_infos.append(cover_info)
+    save_cache_index()
+
+    # Several publishers can share an image, so each one is only cached once.
+    image_urls = {image_url for _, image_url, _ in cover_infos}
+    padded_image_urls: Dict[str, Optional[str]]
+    if not config.no_upload:
+        im_proc.preload_s3_index()
     with Pool(config.concurrency) as pool:
-        processed_cover_images = pool.map(process_cover_image, cover_infos)
+        padded_image_urls = dict(
+            pool.imap_unordered(process_cover_image, image_urls, chunksize=16)
+        )
 
     result = {}
-    for entry in processed_cover_images:
-        result.update({entry[0]: {"cover_url": entry[1], "background_color": entry[2]}})
+    for domain, image_url, background_color in cover_infos:
+        padded_image_url = padded_image_urls[image_url]
+        logger.info(
+            f"The padded image of the {domain} is {padded_image_url} with {background_color}"
+        )
+        result[domain] = {
+            "cover_url": padded_image_url,
+            "background_color": background_color,
+        }
 
     with open(config.output_path / config.cover_info_lookup_file, "wb") as f:
         f.write(orjson.dumps(result))
@@ -3,23 +3,32 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at https://mozilla.org/MPL/2.0/. */
 
-from multiprocessing.pool import Pool, ThreadPool
-from typing import List, Tuple
+import asyncio
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.pool import Pool
+from typing import Dict, List, Optional, Tuple
 from urllib.parse import urljoin
 
+import lxml.etree
+import lxml.html
 import metadata_parser
-import requests
 import structlog
-from bs4 import BeautifulSoup
-from fake_useragent import UserAgent
 from orjson import orjson
 from requests import HTTPError
 
 import image_processor_sandboxed
 from config import get_config
-from utils import get_all_domains, upload_file, uri_validator
-
-ua = UserAgent(browsers=["edge", "chrome", "firefox", "safari", "opera"])
+from utils import (
+    gather_with_session,
+    get_all_domains,
+    get_favicons_lookup,
+    get_http_session,
+    get_user_agent,
+    upload_file,
+    uri_validator,
+)
 
 config = get_config()
 logger = structlog.getLogger(__name__)
@@ -31,83 +40,180 @@ im_proc = image_processor_sandboxed.ImageProcessor(
 # at you https://skysports.com).
 REQUEST_TIMEOUT = 15
 
+# Favicons rarely change, so each run only refetches this share of the domains
+# that already have one, picked at random, so every entry is revalidated sooner
+# or later.
+REFRESH_FRACTION = 0.1
+
+# Every <link> that could point at an icon, in document order.
+icon_links_xpath = lxml.etree.XPath("//link[contains(@rel, 'icon')]")
+
+# Parsers are reused between pages, but an lxml parser can't be shared across
+# threads and the fallbacks run on the event loop's executor threads.
+html_parsers = threading.local()
 
-def get_favicon(domain: str) -> Tuple[str, str]:  # noqa: C901
-    # Set the default favicon path. If we don't find something better, we'll use
-    # this.
-    default_icon_url = "/favicon.ico"
-    icon_url = None
-    try:
-        icon_url = (
-            f"https://t0.gstatic.com/faviconV2?client=SOCIAL&"
-            f"type=FAVICON&fallback_opts=TYPE,SIZE,URL&url={domain}&size=64"
-        )
-        res = requests.get(
-            icon_url, timeout=REQUEST_TIMEOUT, headers={"User-Agent": ua.random}
-        )
 
-        res.raise_for_status()
+async def get_favicon(
+    session, domain: str, executor: ThreadPoolExecutor
+) -> Tuple[str, Optional[str]]:
+    gstatic_url = (
+        f"https://t0.gstatic.com/faviconV2?client=SOCIAL&"
+        f"type=FAVICON&fallback_opts=TYPE,SIZE,URL&url={domain}&size=64"
+    )
+    try:
+        async with session.get(
+            gstatic_url, headers={"User-Agent": get_user_agent()}
+        ) as res:
+            res.raise_for_status()
 
-        if res.status_code != 200:  # raise for status is not working with 3xx error
-            raise HTTPError(f"Http error with status code {res.status_code}")
+            if res.status != 200:  # raise for status is not working with 3xx error
+                raise HTTPError(f"Http error with status code {res.status}")
 
+        icon_url = gstatic_url
     except Exception as e:
         logger.info(
-            f"Failed to download HTML for {domain} with exception {e}. Using default icon path {icon_url}"
+            f"Failed to get the gstatic favicon for {domain} with exception {e}. "
+            f"Looking it up on the site instead."
         )
+        icon_url = None
 
     if icon_url is None:
-        try:
-            page = metadata_parser.MetadataParser(
-                url=domain,
-                support_malformed=True,
-                url_headers={"User-Agent": ua.random},
-                search_head_only=True,
-                strategy=["page", "meta", "og", "dc"],
-                requests_timeout=config.request_timeout,
-            )
-            icon_url = page.get_metadata_link("image")
-        except metadata_parser.NotParsableFetchError as e:
-            if e.code and e.code not in (403, 429, 500, 502, 503):
-                logger.error(f"Error parsing [{domain}]: {e}")
-        except (UnicodeDecodeError, metadata_parser.NotParsable) as e:
-            logger.error(f"Error parsing: {domain} -- {e}")
-        except Exception as e:
-            logger.error(f"Error parsing: {domain} -- {e}")
+        # The fallbacks block, so they run on a thread rather than the event loop.
+        icon_url = await asyncio.get_running_loop().run_in_executor(
+            executor, get_fallback_favicon, domain
+        )
+
+    return domain, icon_url
+
+
+def get_page_head(domain: str, byte_range: Optional[str] = None) -> Tuple[bytes, bool]:
+    """Downloads the page at domain up to its closing </head> tag, since the icon
+    links live in the head. Returns the bytes read and whether the head may
+    continue past what the byte_range let through."""
+    headers = {"User-Agent": get_user_agent()}
+    if byte_range:
+        headers["Range"] = byte_range
+
+    content = bytearray()
+    head_end = -1
+    with get_http_session().get(
+        domain, timeout=REQUEST_TIMEOUT, headers=headers, stream=True
+    ) as response:
+        for chunk in response.iter_content(chunk_size=16 * 1024):
+            # "</head>" may straddle two chunks.
+            start = max(len(content) - len(b"</head>"), 0)
+            content += chunk
+            head_end = content.find(b"</head>", start)
+            if head_end != -1:
+                del content[head_end:]
+                break
+
+    # 416 means the server refused the range, so the page still has to be fetched.
+    # Its body is an error page, whatever head it has.
+    partial = response.status_code == 416 or (
+        response.status_code == 206 and head_end == -1
+    )
+    return bytes(content), partial
+
+
+def get_html_parser() -> lxml.html.HTMLParser:
+    parser = getattr(html_parsers, "parser", None)
+    if parser is None:
+        parser = lxml.html.HTMLParser(remove_comments=True, remove_pis=True)
+        html_parsers.parser = parser
+    return parser
+
+
+def find_icon_links(content: bytes) -> list:
+    # lxml refuses to parse an empty document, e.g. the body of a 416.
+    if not content.strip():
+        return []
+    return icon_links_xpath(lxml.html.fromstring(content, parser=get_html_parser()))
+
+
+def probe_default_favicon(domain: str) -> Optional[str]:
+    """Returns the URL of the site's /favicon.ico if a HEAD request shows an image
+    is served there."""
+    try:
+        response = get_http_session().head(
+            urljoin(domain, "/favicon.ico"),
+            timeout=5,
+            headers={"User-Agent": get_user_agent()},
+            allow_redirects=True,
+        )
+    except Exception:
+        return None
+
+    content_type = response.headers.get("Content-Type", "")
+    if response.status_code != 200 or not content_type.startswith("image/"):
+        return None
+    return response.url if uri_validator(response.url) else None
+
+
+def get_fallback_favicon(domain: str) -> Optional[str]:  # noqa: C901
+    # Most sites serve their icon at the default path, in which case there's no
+    # need to download and parse any HTML.
+    icon_url = probe_default_favicon(domain)
+    if icon_url is not None:
+        return icon_url
+
+    # Set the default favicon path. If we don't find something better, we'll use
+    # this.
+    default_icon_url = "/favicon.ico"
+    try:
+        page = metadata_parser.MetadataParser(
+            url=domain,
+            support_malformed=True,
+            url_headers={"User-Agent": get_user_agent()},
+            search_head_only=True,
+            strategy=["page", "meta", "og", "dc"],
+            requests_timeout=config.request_timeout,
+        )
+        icon_url = page.get_metadata_link("image")
+    except metadata_parser.NotParsableFetchError as e:
+        if e.code and e.code not in (403, 429, 500, 502, 503):
+            logger.error(f"Error parsing [{domain}]: {e}")
+    except (UnicodeDecodeError, metadata_parser.NotParsable) as e:
+        logger.error(f"Error parsing: {domain} -- {e}")
+    except Exception as e:
+        logger.error(f"Error parsing: {domain} -- {e}")
 
     if icon_url is None:
         try:
-            response = requests.get(
-                domain, timeout=REQUEST_TIMEOUT, headers={"User-Agent": ua.random}
-            )
-            soup = BeautifulSoup(response.text, features="lxml")
-            icon = soup.find("link", rel="icon")
+            # Most heads fit in the first 16 KB, but if a server honoured the
+            # range and no icon link turned up, the head may have been cut off.
+            content, partial = get_page_head(domain, byte_range="bytes=0-16383")
+            links = find_icon_links(content)
+            if not links and partial:
+                content, _ = get_page_head(domain)
+                links = find_icon_links(content)
+
+            # "icon" also matches "shortcut icon".
+            icon = next((x for x in links if "icon" in x.get("rel").split()), None)
 
             # Some sites may use an icon with a different rel.
-            if not icon:
-                icon = soup.find("link", rel="shortcut icon")
-            if not icon:
-                icon = soup.find("link", rel="apple-touch-icon")
+            if icon is None:
+                icon = next(
+                    (x for x in links if x.get("rel") == "apple-touch-icon"), None
+                )
 
             # Check if the icon exists, and the href is not empty. Surprisingly,
             # some sites actually do this (https://coinchoice.net/ + more).
-            if icon and icon.get("href"):
+            if icon is not None and icon.get("href"):
                 icon_url = icon.get("href")
         except Exception as e:
             logger.info(
                 f"Failed to download HTML for {domain} with exception {e}. Using default icon path {icon_url}"
             )
 
-        if icon_url is None:
-            # We need to resolve relative urls, so we send something sensible to the client.
-            icon_url = urljoin(domain, icon_url)
-        else:
-            icon_url = urljoin(domain, default_icon_url)
+        # We need to resolve relative urls, so we send something sensible to the
+        # client.
+        icon_url = urljoin(domain, icon_url or default_icon_url)
 
         if not uri_validator(icon_url):
             icon_url = None
 
-    return domain, icon_url
+    return icon_url
 
 
 def process_favicons_image(item):
@@ -133,20 +239,70 @@ def process_favicons_image(item):
     return domain, padded_icon_url
 
 
+async def fetch_and_process_favicon(
+    session,
+    domain: str,
+    pool: Pool,
+    fallback_executor: ThreadPoolExecutor,
+    pool_executor: ThreadPoolExecutor,
+) -> Tuple[str, Optional[str]]:
+    """Looks up the domain's favicon and pads it on the pool straight away, so
+    the padding overlaps with the remaining lookups. The blocking pool.apply
+    runs on an executor thread to keep the event loop free. It has its own
+    executor, so waiting on the pool never holds up the fallback lookups."""
+    item = await get_favicon(session, domain, fallback_executor)
+    return await asyncio.get_running_loop().run_in_executor(
+        pool_executor, pool.apply, process_favicons_image, (item,)
+    )
+
+
 if __name__ == "__main__":
-    domains = list(set(get_all_domains()))
-    logger.info(f"Processing {len(domains)} domains")
+    domains = set(get_all_domains())
+    previous_favicons = get_favicons_lookup()
+
+    # Keep the previous result for domains that still have a favicon, and only
+    # look up the new ones, the failed ones and a random share of the rest.
+    processed_favicons: Dict[str, str] = {
+        domain: icon_url
+        for domain, icon_url in previous_favicons.items()
+        if domain in domains and icon_url
+    }
+    stale_domains = [
+        domain
+        for domain in domains
+        if domain not in processed_favicons
+        or random.random() < REFRESH_FRACTION  # nosec B311
+    ]
+    logger.info(
+        f"Processing {len(stale_domains)} of {len(domains)} domains, "
+        f"reusing {len(domains) - len(stale_domains)} previous favicons"
+    )
 
-    favicons: List[Tuple[str, str]]
-    with ThreadPool(config.thread_pool_size) as pool:
-        favicons = pool.map(get_favicon, domains)
+    if not config.no_upload:
+        im_proc.preload_s3_index()
+    # The fallback lookups block on IO, so they get as many threads as the other
+    # IO bound stages. More threads than pool workers would only wait on the pool.
+    with Pool(config.concurrency) as pool, ThreadPoolExecutor(
+        config.thread_pool_size
+    ) as fallback_executor, ThreadPoolExecutor(config.concurrency) as pool_executor:
+        favicons: List[Tuple[str, Optional[str]]] = asyncio.run(
+            gather_with_session(
+                fetch_and_process_favicon,
+                stale_domains,
+                pool,
+                fallback_executor,
+                pool_executor,
+                timeout=REQUEST_TIMEOUT,
+            )
+        )
 
-    processed_favicons: List[Tuple[str, str]]
-    with Pool(config.concurrency) as pool:
-        processed_favicons = pool.map(process_favicons_image, favicons)
+    for domain, padded_icon_url in favicons:
+        # A failed refresh keeps the favicon we already had.
+        if padded_icon_url or domain not in processed_favicons:
+            processed_favicons[domain] = padded_icon_url
 
     with open(config.output_path / config.favicon_lookup_file, "wb") as f:
-        f.write(orjson.dumps(dict(processed_favicons)))
+        f.write(orjson.dumps(processed_favicons))
 
     logger.info("Fetched all the favicons!")
 
@@ -3,35 +3,45 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at https://mozilla.org/MPL/2.0/. */
 
+import asyncio
+import atexit
+import base64
+import email.utils
+import gzip
 import hashlib
 import html
-import json
 import logging
-import math
+import re
 import shutil
 import sys
 import time
 import warnings
 from collections import defaultdict
 from datetime import datetime, timedelta
-from functools import partial
 from multiprocessing import Pool as ProcessPool
 from multiprocessing.pool import ThreadPool
+from operator import itemgetter
 from pathlib import Path
+from typing import Optional
 from urllib.parse import quote, urlparse, urlunparse
 
-import bleach
+import ahocorasick
+import aiohttp
 import dateparser
 import feedparser
+import lxml.etree
+import lxml.html
 import metadata_parser
+import numpy as np
 import orjson
 import pytz
 import requests
 import structlog
 import unshortenit
 from better_profanity import profanity
+from botocore.exceptions import BotoCoreError, ClientError
 from bs4 import BeautifulSoup as BS
-from fake_useragent import UserAgent
+from bs4 import SoupStrainer
 from prometheus_client import CollectorRegistry, Gauge, multiprocess
 from requests.exceptions import (
     ConnectTimeout,
@@ -43,10 +53,19 @@ from requests.exceptions import (
 )
 
 from config import get_config
+from models.base import clean_str
 from src import image_processor_sandboxed
-from utils import push_metrics_to_pushgateway, upload_file
-
-ua = UserAgent(browsers=["edge", "chrome", "firefox", "safari", "opera"])
+from utils import (
+    flush_metrics,
+    gather_with_session,
+    get_chunksize,
+    get_http_session,
+    get_user_agent,
+    push_metrics_to_pushgateway,
+    s3_client,
+    upload_file,
+    upload_files,
+)
 
 config = get_config()
 
@@ -67,6 +86,60 @@ logger = structlog.getLogger(__name__)
 custom_badwords = ["vibrators", "hedonistic"]
 profanity.add_censor_words(custom_badwords)
 
+
+def get_fold_table(chars_mapping):
+    """Folds every group of characters better_profanity treats as substitutes for
+    each other (like a, @ and 4) into a single character."""
+    groups = []
+    for char, substitutes in chars_mapping.items():
+        group = {char, *substitutes}
+        for overlapping in [g for g in groups if g & group]:
+            group |= overlapping
+            groups.remove(overlapping)
+        groups.append(group)
+    return str.maketrans({char: min(group) for group in groups for char in group})
+
+
+# better_profanity splits the text into words on every character outside its
+# ALLOWED_CHARACTERS, and those separators never take part in a match.
+profanity_separators_re = re.compile(
+    "[^%s]+" % "".join(re.escape(char) for char in sorted(profanity.ALLOWED_CHARACTERS))
+)
+
+# Finds every folded bad word in a single pass over a title, with the separators
+# dropped from both. With the characters folded it matches a superset of what
+# better_profanity does.
+profanity_fold_table = get_fold_table(profanity.CHARS_MAPPING)
+profanity_automaton = ahocorasick.Automaton()
+for censor_word in profanity.CENSOR_WORDSET:
+    folded_word = profanity_separators_re.sub("", str(censor_word).lower())
+    folded_word = folded_word.translate(profanity_fold_table)
+    if folded_word:
+        profanity_automaton.add_word(folded_word, len(folded_word))
+profanity_automaton.make_automaton()
+
+
+def contains_profanity(text):
+    """Only the few texts the automaton flags go through better_profanity's much
+    slower check, which decides."""
+    words = [word.lower() for word in profanity_separators_re.split(text)]
+
+    # better_profanity matches whole words, or a few adjacent words run together
+    # (with or without the separators between them), so a candidate has to start
+    # and end where words do in the joined text.
+    boundaries = {0}
+    position = 0
+    for word in words:
+        position += len(word)
+        boundaries.add(position)
+
+    joined = "".join(words).translate(profanity_fold_table)
+    for end, length in profanity_automaton.iter(joined):
+        if end - length + 1 in boundaries and end + 1 in boundaries:
+            return profanity.contains_profanity(text)
+    return False
+
+
 registry = CollectorRegistry()
 multiprocess.MultiProcessCollector(registry)
 
@@ -86,30 +159,153 @@ PUBLISHER_URL_ERR_ALERT_NAME_METRIC = Gauge(
     labelnames=["url"],
 )
 
+# Metrics are only recorded in the main process, the pool workers report their
+# failures back in their results. They're all pushed once on exit.
+atexit.register(flush_metrics, registry)
+
 
 def get_with_max_size(url, max_bytes=10000000):
-    response = requests.get(
+    with get_http_session().get(
         url,
+        stream=True,
         timeout=config.request_timeout,
-        headers={"User-Agent": ua.random},
-    )
-    response.raise_for_status()
+        headers={"User-Agent": get_user_agent()},
+    ) as response:
+        response.raise_for_status()
 
-    if response.status_code != 200:  # raise for status is not working with 3xx error
-        raise HTTPError(f"Http error with status code {response.status_code}")
+        if response.status_code != 200:  # raise for status is not working with 3xx
+            raise HTTPError(f"Http error with status code {response.status_code}")
 
-    if (
-        response.headers.get("Content-Length")
-        and int(response.headers.get("Content-Length")) > max_bytes
-    ):
+        if (
+            response.headers.get("Content-Length")
+            and int(response.headers.get("Content-Length")) > max_bytes
+        ):
+            raise ValueError("Content-Length too large")
+
+        # The Content-Length can be missing or wrong, so also stop reading as soon
+        # as the body gets too large.
+        content = bytearray()
+        for chunk in response.iter_content(64 * 1024):
+            content += chunk
+            if len(content) > max_bytes:
+                raise ValueError("Content too large")
+
+        return bytes(content)
+
+
+def load_feed_cache(name):
+    """The body of the last download of every feed and the validators to make the
+    next request conditional with, by feed URL. Without a cache, every feed is
+    downloaded in full."""
+    try:
+        if not config.no_download:
+            response = s3_client.get_object(Bucket=config.private_s3_bucket, Key=name)
+            data = response["Body"].read()
+        else:
+            with open(config.output_path / Path(name).name, "rb") as f:
+                data = f.read()
+        cached_feeds = orjson.loads(gzip.decompress(data))
+        return {
+            feed: {
+                "body": base64.b64decode(cached["body"]),
+                "validators": cached["validators"],
+            }
+            for feed, cached in cached_feeds.items()
+        }
+    except (BotoCoreError, ClientError, OSError, ValueError) as e:
+        logger.info(f"Downloading every feed in full, no feed cache {name}: {e}")
+        return {}
+
+
+def save_feed_cache(name, downloaded_feeds):
+    """Only the feeds downloaded in this run are kept, so feeds that were removed
+    or failed drop out of the cache."""
+    cached_feeds = {
+        result["key"]: {
+            "body": base64.b64encode(result["feed_cache"]).decode(),
+            "validators": result["validators"],
+        }
+        for result in downloaded_feeds
+        if result["validators"]  # the server doesn't support conditional requests
+    }
+    path = config.output_path / Path(name).name
+    try:
+        with open(path, "wb") as f:
+            # The default level is much slower, for little gain.
+            f.write(gzip.compress(orjson.dumps(cached_feeds), compresslevel=6))
+        if not config.no_upload:
+            upload_file(path, config.private_s3_bucket, name)
+    except Exception as e:
+        logger.error(f"Failed to save the feed cache {name}: {e}")
+
+
+async def read_with_max_size(response, max_bytes):
+    if response.content_length and response.content_length > max_bytes:
         raise ValueError("Content-Length too large")
 
-    return response.content
+    # The Content-Length can be missing or wrong, so also stop reading as soon as
+    # the body gets too large.
+    content = bytearray()
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        content += chunk
+        if len(content) > max_bytes:
+            raise ValueError("Content too large")
+
+    return bytes(content)
+
+
+async def get_with_max_size_async(session, url, max_bytes=10000000, cached=None):
+    """Returns the body and the validators for the next conditional request.
+    Given a cached copy, it returns that when the server answers 304 Not
+    Modified."""
+    headers = {"User-Agent": get_user_agent()}
+    if cached:
+        headers.update(cached["validators"])
+
+    async with session.get(url, headers=headers) as response:
+        if cached and response.status == 304:
+            return cached["body"], cached["validators"]
+
+        response.raise_for_status()
+
+        if response.status != 200:  # raise for status is not working with 3xx
+            raise HTTPError(f"Http error with status code {response.status}")
+
+        validators = {}
+        if "ETag" in response.headers:
+            validators["If-None-Match"] = response.headers["ETag"]
+        if "Last-Modified" in response.headers:
+            validators["If-Modified-Since"] = response.headers["Last-Modified"]
+
+        return await read_with_max_size(response, max_bytes), validators
 
 
-def download_feed(feed, max_feed_size=10000000):
+def report_parse_error(feed):
+    prom_label = urlparse(feed).hostname
+    prom_label = prom_label.replace(".", "_")
+    push_metrics_to_pushgateway(
+        PUBLISHER_ARTICLE_ALERT_NAME_METRIC, 1, prom_label, registry
+    )
+
+
+def report_feed_error(feed, message):
+    logger.error(message)
+    prom_label = urlparse(feed).hostname
+    prom_label = prom_label.replace(".", "_")
+    push_metrics_to_pushgateway(
+        PUBLISHER_URL_ERR_ALERT_NAME_METRIC, 1, prom_label, registry
+    )
+
+
+async def download_feed_async(session, feed, cached_feeds=None, max_feed_size=10000000):
+    """Downloads the feed on the shared aiohttp session, falling back to plain
+    HTTP. Feeds in cached_feeds that haven't changed since aren't downloaded
+    again."""
+    cached = cached_feeds.get(feed) if cached_feeds else None
     try:
-        data = get_with_max_size(feed, max_feed_size)
+        data, validators = await get_with_max_size_async(
+            session, feed, max_feed_size, cached
+        )
         logger.debug(f"Downloaded feed: {feed}")
     except Exception:
         # Failed to get feed. I will try plain HTTP.
@@ -117,33 +313,77 @@ def download_feed(feed, max_feed_size=10000000):
             u = urlparse(feed)
             u = u._replace(scheme="http")
             feed_url = urlunparse(u)
-            data = get_with_max_size(feed_url, max_feed_size)
-        except ReadTimeout as e:
-            logger.error(f"Failed to get feed: {feed} ({e})")
-            prom_label = urlparse(feed).hostname
-            prom_label = prom_label.replace(".", "_")
-            push_metrics_to_pushgateway(
-                PUBLISHER_URL_ERR_ALERT_NAME_METRIC, 1, prom_label, registry
-            )
-            return None
-        except HTTPError as e:
-            prom_label = urlparse(feed).hostname
-            prom_label = prom_label.replace(".", "_")
-            logger.error(f"Failed to get feed: {feed} ({e})")
-            push_metrics_to_pushgateway(
-                PUBLISHER_URL_ERR_ALERT_NAME_METRIC, 1, prom_label, registry
+            data, validators = await get_with_max_size_async(
+                session, feed_url, max_feed_size, cached
             )
+        except (asyncio.TimeoutError, aiohttp.ClientResponseError, HTTPError) as e:
+            report_feed_error(feed, f"Failed to get feed: {feed} ({e})")
             return None
         except Exception as e:
-            logger.error(f"Failed to get [{e}]: {feed}")
-            prom_label = urlparse(feed).hostname
-            prom_label = prom_label.replace(".", "_")
-            push_metrics_to_pushgateway(
-                PUBLISHER_URL_ERR_ALERT_NAME_METRIC, 1, prom_label, registry
-            )
+            report_feed_error(feed, f"Failed to get [{e}]: {feed}")
             return None
 
-    return {"feed_cache": data, "key": feed}
+    return {"feed_cache": data, "key": feed, "validators": validators}
+
+
+def parse_json_feed(data):
+    """Maps a JSON Feed (https://www.jsonfeed.org/version/1.1/) onto the parts
+    of feedparser's result that the rest of the pipeline reads."""
+    entries = []
+    for item in orjson.loads(data).get("items", []):
+        entry = {
+            "title": item.get("title"),
+            "link": item.get("url") or item.get("external_url"),
+            "updated": item.get("date_modified"),
+            "published": item.get("date_published"),
+            "image": item.get("image") or item.get("banner_image"),
+            "summary": item.get("content_html") or item.get("summary"),
+            "description": item.get("summary") or item.get("content_text"),
+            "enclosures": [
+                {
+                    "href": attachment.get("url"),
+                    "type": attachment.get("mime_type"),
+                    "length": attachment.get("size_in_bytes"),
+                }
+                for attachment in item.get("attachments", [])
+            ],
+        }
+        entries.append({k: v for k, v in entry.items() if v})
+
+    return {"items": entries, "entries": entries}
+
+
+# Everything process_articles reads from an entry.
+entry_keys = (
+    "title",
+    "link",
+    "url",
+    "updated",
+    "updated_parsed",
+    "published",
+    "published_parsed",
+    "image",
+    "urlToImage",
+    "media_content",
+    "media_thumbnail",
+    "summary",
+    "content",
+    "description",
+    "enclosures",
+    "category",
+)
+
+
+def to_feed_cache(parsed_feed):
+    """Only the entries are used, so only their fields process_articles needs are
+    kept. As plain dicts they're much cheaper to send between processes than
+    feedparser's FeedParserDicts. .get still resolves feedparser's aliases."""
+    return {
+        "entries": [
+            {key: entry.get(key) for key in entry_keys}
+            for entry in parsed_feed["entries"]
+        ]
+    }
 
 
 def parse_rss(downloaded_feed):
@@ -151,26 +391,23 @@ def parse_rss(downloaded_feed):
     url, data = downloaded_feed["key"], downloaded_feed["feed_cache"]
 
     try:
-        feed_cache = feedparser.parse(data)
+        if data.lstrip()[:1] == b"{":
+            feed_cache = parse_json_feed(data)
+        else:
+            # Everything we keep is sanitized later on with clean_str, so skip
+            # feedparser's own pass over the HTML. Relative links still need to
+            # be resolved against the feed's xml:base, though.
+            feed_cache = feedparser.parse(data, sanitize_html=False)
         report["size_after_get"] = len(feed_cache["items"])
         if report["size_after_get"] == 0:
             logger.info(f"Read 0 articles from {url}")
             raise Exception(f"Read 0 articles from {url}")
     except Exception as e:
         logger.error(f"Feed failed to parse [{e}]: {url}")
-        prom_label = urlparse(url).hostname
-        prom_label = prom_label.replace(".", "_")
-        push_metrics_to_pushgateway(
-            PUBLISHER_ARTICLE_ALERT_NAME_METRIC, 1, prom_label, registry
-        )
-        return None
+        # This runs on the pool, so the caller records the failure.
+        return {"report": report, "feed_cache": None, "key": url}
 
-    feed_cache = dict(feed_cache)  # bypass serialization issues
-
-    if "bozo_exception" in feed_cache:
-        del feed_cache["bozo_exception"]
-
-    return {"report": report, "feed_cache": feed_cache, "key": url}
+    return {"report": report, "feed_cache": to_feed_cache(feed_cache), "key": url}
 
 
 def process_image(item):
@@ -200,6 +437,40 @@ def process_image(item):
     return item
 
 
+html_tag_re = re.compile(r"<[^>]+>")
+
+
+def strip_html(markup: str) -> str:
+    """The text content of an HTML fragment, without building a soup for it."""
+    if "<" not in markup:
+        # Most titles and descriptions are plain text, only entities to decode.
+        return html.unescape(markup)
+
+    try:
+        return str(
+            lxml.html.fragment_fromstring(markup, create_parent="div").text_content()
+        )
+    except (lxml.etree.ParserError, ValueError):
+        return html_tag_re.sub("", markup)
+
+
+img_src_re = re.compile(
+    r"""<img\s(?:[^>]*?\s)?src\s*=\s*["']([^"'>]+)["']""", re.IGNORECASE
+)
+img_only = SoupStrainer("img")
+
+
+def get_first_img_src(markup):
+    """The src of the first <img> in the markup. Most markup is simple enough for
+    a regex, anything else is parsed keeping only the <img> tags."""
+    match = img_src_re.search(markup)
+    if match:
+        return html.unescape(match.group(1))
+
+    img_tag = BS(markup, features="lxml", parse_only=img_only).find("img", src=True)
+    return img_tag.get("src") if img_tag else ""
+
+
 def get_article_img(article):  # noqa: C901
     # image determination
     img_url = ""
@@ -224,24 +495,40 @@ def get_article_img(article):  # noqa: C901
                 img_url = content.get("url")
 
     elif article.get("summary"):
-        soup = BS(article["summary"], features="html.parser")
-        image_tags = soup.find_all("img")
-        for img_tag in image_tags:
-            if "src" in img_tag.attrs:
-                img_url = img_tag.get("src")
-                break
+        img_url = get_first_img_src(article["summary"])
 
     elif article.get("content"):
-        soup = BS(article["content"][0]["value"], features="html.parser")
-        image_tags = soup.find_all("img")
-        for img_tag in image_tags:
-            if "src" in img_tag.attrs:
-                img_url = img_tag.get("src")
-                break
+        img_url = get_first_img_src(article["content"][0]["value"])
 
     return img_url
 
 
+def process_article_job(job):
+    return process_articles(*job)
+
+
+def parse_publish_time(article, key):
+    """feedparser already parses the dates it understands into UTC struct_times.
+    The rest (and JSON feeds) are mostly RFC 822 or ISO 8601, so dateparser is
+    only needed as a last resort."""
+    parsed = article.get(f"{key}_parsed")
+    if parsed:
+        return datetime(*parsed[:6], tzinfo=pytz.utc)
+
+    value = article[key]
+    try:
+        return email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        pass
+
+    return dateparser.parse(value)
+
+
 def process_articles(article, _publisher):  # noqa: C901
     out_article = {}
 
@@ -249,11 +536,11 @@ def process_articles(article, _publisher):  # noqa: C901
     if not article.get("title"):
         # No title. Skip.
         return None
-    out_article["title"] = BS(article["title"], features="html.parser").get_text()
+    out_article["title"] = strip_html(article["title"])
     out_article["title"] = html.unescape(out_article["title"])
 
     # Filter the offensive articles
-    if profanity.contains_profanity(out_article.get("title").lower()):
+    if contains_profanity(out_article.get("title")):
         return None
 
     # Process article URL
@@ -266,9 +553,9 @@ def process_articles(article, _publisher):  # noqa: C901
 
     # Process published time
     if article.get("updated"):
-        out_article["publish_time"] = dateparser.parse(article.get("updated"))
+        out_article["publish_time"] = parse_publish_time(article, "updated")
     elif article.get("published"):
-        out_article["publish_time"] = dateparser.parse(article.get("published"))
+        out_article["publish_time"] = parse_publish_time(article, "published")
     else:
         return None  # skip (no update field)
 
@@ -287,6 +574,8 @@ def process_articles(article, _publisher):  # noqa: C901
         ):
             return None  # skip (newer than now() or older than 1 month)
 
+    # Kept for score_entries, so it doesn't have to parse publish_time back.
+    out_article["_ts"] = out_article["publish_time"].timestamp()
     out_article["publish_time"] = out_article["publish_time"].strftime(
         "%Y-%m-%d %H:%M:%S"
     )
@@ -296,9 +585,7 @@ def process_articles(article, _publisher):  # noqa: C901
     # Add some fields
     out_article["category"] = _publisher.get("category")
     if article.get("description"):
-        out_article["description"] = BS(
-            article["description"], features="html.parser"
-        ).get_text()
+        out_article["description"] = strip_html(article["description"])
     else:
         out_article["description"] = ""
 
@@ -315,14 +602,22 @@ def process_articles(article, _publisher):  # noqa: C901
     return out_article
 
 
-def unshorten_url(out_article):
-    unshortener = unshortenit.UnshortenIt(
-        default_timeout=config.request_timeout,
-        default_headers={"User-Agent": ua.random},
-    )
+unshortener = None
+
 
+def get_unshortener() -> unshortenit.UnshortenIt:
+    global unshortener
+    if unshortener is None:
+        unshortener = unshortenit.UnshortenIt(
+            default_timeout=config.request_timeout,
+            default_headers={"User-Agent": get_user_agent()},
+        )
+    return unshortener
+
+
+def unshorten_url(out_article):
     try:
-        out_article["url"] = unshortener.unshorten(out_article["link"])
+        out_article["url"] = get_unshortener().unshorten(out_article["link"])
         out_article.pop("link", None)
     except (
         requests.exceptions.ConnectionError,
@@ -337,7 +632,9 @@ def unshorten_url(out_article):
         logger.error(f"unshortener failed [{out_article.get('link')}]: {e}")
         return None  # skip (unshortener failed)
 
-    url_hash = hashlib.sha256(out_article["url"].encode("utf-8")).hexdigest()
+    url_hash = hashlib.new(
+        config.url_hash_algorithm, out_article["url"].encode("utf-8")
+    ).hexdigest()
     parts = urlparse(out_article["url"])
     parts = parts._replace(path=quote(parts.path))
     encoded_url = urlunparse(parts)
@@ -362,7 +659,40 @@ def get_popularity_score(out_article):
     return out_article
 
 
-def check_images_in_item(article, _publishers):  # noqa: C901
+def resolve_article(out_article):
+    """Both steps wait on the network, so they share a thread instead of each
+    stage waiting for the slowest article of the previous one."""
+    out_article = unshorten_url(out_article)
+    if not out_article:
+        return None
+
+    return get_popularity_score(out_article)
+
+
+async def get_page_html(session, url, max_bytes=1000000):
+    """Returns the page at url, or None if it isn't HTML and so can't have any
+    metadata."""
+    async with session.get(url, headers={"User-Agent": get_user_agent()}) as response:
+        response.raise_for_status()
+        if response.content_type not in ("text/html", "application/xhtml+xml"):
+            return None
+
+        content = await read_with_max_size(response, max_bytes)
+        return content.decode(response.charset or "utf-8", errors="replace")
+
+
+def parse_metadata(url, page_html):
+    return metadata_parser.MetadataParser(
+        url=url,
+        html=page_html,
+        support_malformed=True,
+        search_head_only=True,
+        strategy=["page", "meta", "og", "dc"],
+    )
+
+
+async def check_images_in_item(session, article, _publishers):  # noqa: C901
+    og_images = _publishers[article["publisher_id"]]["og_images"]
     if article["img"]:
         try:
             parsed_img_url = urlparse(article["img"])
@@ -378,24 +708,21 @@ def check_images_in_item(article, _publishers):  # noqa: C901
             logger.error(f"Can't parse image [{article['img']}]: {e}")
             article["img"] = ""
 
-    if (
-        article["img"] == ""
-        or _publishers[article["publisher_id"]]["og_images"] is True
-    ):
+    if article["img"] == "" or og_images is True:
         # if we came out of this without an image, lets try to get it from opengraph
         try:
-            page = metadata_parser.MetadataParser(
-                url=article["url"],
-                support_malformed=True,
-                url_headers={"User-Agent": ua.random},
-                search_head_only=True,
-                strategy=["page", "meta", "og", "dc"],
-                requests_timeout=config.request_timeout,
-            )
-            article["img"] = page.get_metadata_link("image")
-        except metadata_parser.NotParsableFetchError as e:
-            if e.code and e.code not in (403, 429, 500, 502, 503):
+            page_html = await get_page_html(session, article["url"])
+            if page_html is not None:
+                # Parsing is CPU bound, keep it off the event loop.
+                page = await asyncio.get_running_loop().run_in_executor(
+                    None, parse_metadata, article["url"], page_html
+                )
+                article["img"] = page.get_metadata_link("image")
+        except aiohttp.ClientResponseError as e:
+            if e.status not in (403, 429, 500, 502, 503):
                 logger.error(f"Error parsing [{article['url']}]: {e}")
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass  # unreachable pages are expected, we just keep the current image
         except (UnicodeDecodeError, metadata_parser.NotParsable) as e:
             logger.error(f"Error parsing: {article['url']} -- {e}")
         except Exception as e:
@@ -410,82 +737,142 @@ def scrub_html(feed: dict):
     """Scrubbing HTML of all entries that will be written to feed"""
     for key in feed.keys():
         try:
-            feed[key] = bleach.clean(feed[key], strip=True)
-            feed[key] = feed[key].replace(
-                "&amp;", "&"
-            )  # workaround limitation in bleach
+            feed[key] = clean_str(feed[key])
         except Exception:
             feed[key] = feed[key]
 
     return feed
 
 
+def get_entry_timestamp(entry):
+    """Removes the _ts process_articles stashed, as it's not published, and
+    returns it. Entries without one have their publish_time parsed instead."""
+    timestamp = entry.pop("_ts", None)
+    if timestamp is None:
+        publish_time = datetime.strptime(entry["publish_time"], "%Y-%m-%d %H:%M:%S")
+        timestamp = publish_time.replace(tzinfo=pytz.utc).timestamp()
+    return timestamp
+
+
 def score_entries(entries):
-    out_entries = []
-    variety_by_source = {}
-    for entry in entries:
-        seconds_ago = (
-            datetime.utcnow() - dateparser.parse(entry["publish_time"])
-        ).total_seconds()
-        recency = math.log(seconds_ago) if seconds_ago > 0 else 0.1
-        if entry["publisher_id"] in variety_by_source:
-            last_variety = variety_by_source[entry["publisher_id"]]
-        else:
-            last_variety = 1.0
-        variety = last_variety * 2.0
-        score = recency * variety
+    """Scores the entries, which must be sorted newest first. An entry's score is
+    its log age, doubled for every entry of the same publisher before it."""
+    if not entries:
+        return []
+
+    seconds_ago = time.time() - np.fromiter(
+        map(get_entry_timestamp, entries), dtype=np.float64, count=len(entries)
+    )
+    recency = np.log(
+        seconds_ago, out=np.full_like(seconds_ago, 0.1), where=seconds_ago > 0
+    )
+
+    # The position of every entry among the entries of its publisher.
+    _, publishers = np.unique(
+        [entry["publisher_id"] for entry in entries], return_inverse=True
+    )
+    order = np.argsort(publishers, kind="stable")
+    grouped = publishers[order]
+    group_starts = np.flatnonzero(np.r_[True, grouped[1:] != grouped[:-1]])
+    occurrence = np.empty(len(entries), dtype=np.int64)
+    occurrence[order] = np.arange(len(entries)) - np.repeat(
+        group_starts, np.diff(np.r_[group_starts, len(entries)])
+    )
+    variety = np.power(2.0, occurrence + 1)
+
+    for entry, score in zip(entries, (recency * variety).tolist()):
         entry["score"] = score
-        out_entries.append(entry)
-        variety_by_source[entry["publisher_id"]] = variety
-    return out_entries
+    return entries
 
 
 class FeedProcessor:
-    def __init__(self, _publishers: dict, _output_path: Path):
+    def __init__(
+        self,
+        _publishers: dict,
+        _output_path: Path,
+        _feed_cache_name: Optional[str] = None,
+    ):
         self.report = defaultdict(dict)  # holds reports and stats of all actions
         self.feeds = defaultdict(dict)
         self.publishers: dict = _publishers
         self.output_path: Path = _output_path
+        # S3 key of the feeds downloaded in the last run, see load_feed_cache.
+        self.feed_cache_name: Optional[str] = _feed_cache_name
+        self._pool = None
+
+    @property
+    def pool(self):
+        """Process pool shared by every stage, so the workers are forked once
+        per run instead of once per stage and per feed."""
+        if self._pool is None:
+            self._pool = ProcessPool(config.concurrency)
+        return self._pool
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
 
     def check_images(self, items):
-        out_items = []
         logger.info(f"Checking images for {len(items)} items...")
-        with ThreadPool(config.thread_pool_size) as pool:
-            for item in pool.imap_unordered(
-                partial(check_images_in_item, _publishers=self.feeds), items
-            ):
-                out_items.append(item)
+        out_items = asyncio.run(
+            gather_with_session(check_images_in_item, items, self.feeds)
+        )
 
         logger.info(f"Caching images for {len(out_items)} items...")
-        with ProcessPool(config.concurrency) as pool:
-            result = []
-            for item in pool.imap_unordered(process_image, out_items):
-                result.append(item)
+        if not config.no_upload and im_proc.uploaded is None:
+            im_proc.preload_s3_index()
+            if im_proc.uploaded is not None:
+                # The workers only see the index if they're forked after it's
+                # loaded, so start a new pool.
+                self.close()
+        result = []
+        for item in self.pool.imap_unordered(
+            process_image, out_items, chunksize=get_chunksize(out_items)
+        ):
+            result.append(item)
         return result
 
     def download_feeds(self):
         downloaded_feeds = []
         feed_cache = {}
         logger.info(f"Downloading {len(self.publishers)} feeds...")
-        with ThreadPool(config.thread_pool_size) as pool:
-            for result in pool.imap_unordered(
-                download_feed,
-                [self.publishers[key]["feed_url"] for key in self.publishers],
-            ):
-                if not result:
-                    continue
-                downloaded_feeds.append(result)
-
-        with ProcessPool(config.concurrency) as pool:
-            for result in pool.imap_unordered(parse_rss, downloaded_feeds):
-                if not result:
-                    continue
+        # Grouping the feeds by host lets consecutive requests reuse connections.
+        feed_urls = sorted(
+            (self.publishers[key]["feed_url"] for key in self.publishers),
+            key=lambda url: urlparse(url).hostname or "",
+        )
+        cached_feeds = {}
+        if self.feed_cache_name:
+            cached_feeds = load_feed_cache(self.feed_cache_name)
+        for result in asyncio.run(
+            gather_with_session(download_feed_async, feed_urls, cached_feeds)
+        ):
+            if not result:
+                continue
+            downloaded_feeds.append(result)
+        if self.feed_cache_name:
+            save_feed_cache(self.feed_cache_name, downloaded_feeds)
+
+        for result in self.pool.imap_unordered(
+            parse_rss, downloaded_feeds, chunksize=get_chunksize(downloaded_feeds)
+        ):
+            if result["feed_cache"] is None:
+                report_parse_error(result["key"])
+                continue
 
-                self.report["feed_stats"][result["key"]] = result["report"]
-                feed_cache[result["key"]] = result["feed_cache"]
-                self.feeds[
-                    self.publishers[result["key"]]["publisher_id"]
-                ] = self.publishers[result["key"]]
+            self.report["feed_stats"][result["key"]] = result["report"]
+            feed_cache[result["key"]] = result["feed_cache"]
+            self.feeds[
+                self.publishers[result["key"]]["publisher_id"]
+            ] = self.publishers[result["key"]]
 
         return feed_cache
 
@@ -499,64 +886,52 @@ class FeedProcessor:
         logger.info(
             f"Fixing up and extracting the data for the items in {len(feed_cache)} feeds..."
         )
+        # One job per article across all the feeds, so the workers don't drain
+        # between feeds.
+        jobs = []
         for key in feed_cache:
-            logger.debug(f"processing: {key}")
-            start_time = time.time()
-            with ProcessPool(config.concurrency) as pool:
-                for out_item in pool.imap_unordered(
-                    partial(process_articles, _publisher=self.publishers[key]),
-                    feed_cache[key]["entries"][: self.publishers[key]["max_entries"]],
-                ):
-                    if out_item:
-                        raw_entries.append(out_item)
-                    self.report["feed_stats"][key]["size_after_insert"] += 1
-            end_time = time.time()
-            logger.debug(
-                f"processed {key} in {round((end_time - start_time) * 1000)} ms"
-            )
+            articles = feed_cache[key]["entries"][: self.publishers[key]["max_entries"]]
+            self.report["feed_stats"][key]["size_after_insert"] += len(articles)
+            jobs.extend((article, self.publishers[key]) for article in articles)
+
+        # Syndicated articles show up in several feeds. Only one copy survives the
+        # url_hash dedup in aggregate_rss, so drop the rest before unshortening.
+        seen_links = set()
+        for out_item in self.pool.imap_unordered(
+            process_article_job, jobs, chunksize=64
+        ):
+            if out_item and out_item["link"] not in seen_links:
+                seen_links.add(out_item["link"])
+                raw_entries.append(out_item)
 
-        logger.info(f"Un-shorten the URL of {len(raw_entries)}")
+        logger.info(f"Un-shorten and get the Popularity score of {len(raw_entries)}")
         with ThreadPool(config.thread_pool_size) as pool:
-            for result in pool.imap_unordered(unshorten_url, raw_entries):
+            for result in pool.imap_unordered(resolve_article, raw_entries):
                 if not result:
                     continue
                 entries.append(result)
 
-        raw_entries.clear()
-
-        logger.info(f"Getting the Popularity score the URL of {len(entries)}")
-        with ThreadPool(config.thread_pool_size) as pool:
-            for result in pool.imap_unordered(get_popularity_score, entries):
-                if not result:
-                    continue
-                raw_entries.append(result)
-
-        return raw_entries
+        return entries
 
     def aggregate_rss(self):
-        entries = []
-        filtered_entries = []
-        entries += self.get_rss()
+        # Distinct links can unshorten to the same URL. Keep one entry per url_hash
+        # before the image stages, instead of deduplicating at the end.
+        entries = list({entry["url_hash"]: entry for entry in self.get_rss()}.values())
 
         logger.info(f"Getting images for {len(entries)} items...")
-        fixed_entries = self.check_images(entries)
-        entries.clear()
+        entries = self.check_images(entries)
 
-        logger.info(f"Scrubbing {len(fixed_entries)} items...")
-        with ProcessPool(config.concurrency) as pool:
-            for result in pool.imap_unordered(scrub_html, fixed_entries):
-                filtered_entries.append(result)
-        fixed_entries.clear()
+        logger.info(f"Scrubbing {len(entries)} items...")
+        # nh3 releases the GIL, so threads avoid pickling the entries to and from
+        # the process pool.
+        with ThreadPool(config.concurrency) as pool:
+            entries = list(pool.imap_unordered(scrub_html, entries, chunksize=64))
 
-        sorted_entries = list({d["url_hash"]: d for d in filtered_entries}.values())
+        logger.info(f"Sorting for {len(entries)} items...")
+        # The publish_time format sorts the same as the times themselves.
+        entries.sort(key=itemgetter("publish_time"), reverse=True)
 
-        logger.info(f"Sorting for {len(sorted_entries)} items...")
-        sorted_entries = sorted(sorted_entries, key=lambda entry: entry["publish_time"])
-        sorted_entries.reverse()
-        filtered_entries.clear()
-
-        filtered_entries = score_entries(sorted_entries)
-        return filtered_entries
+        return score_entries(entries)
 
     def aggregate(self):
         with open(self.output_path, "wb") as _f:
@@ -572,8 +947,8 @@ class FeedProcessor:
             else:
                 by_category[item["category"]].append(item)
         for key in by_category:
-            with open(f"feed/category/{key}.json", "w") as _f:
-                _f.write(json.dumps(by_category[key]))
+            with open(f"feed/category/{key}.json", "wb") as _f:
+                _f.write(orjson.dumps(by_category[key]))
 
 
 if __name__ == "__main__":
@@ -585,26 +960,35 @@ if __name__ == "__main__":
     with open(config.output_path / f"{category}.json") as f:
         publishers = orjson.loads(f.read())
         output_path = config.output_feed_path / f"{category}.json-tmp"
-        fp = FeedProcessor(publishers, output_path)
-        fp.aggregate()
+        feed_cache_name = (
+            f"brave-today/feed_cache/{category}"
+            f"{str(config.sources_file).replace('sources', '')}.json.gz"
+        )
+        with FeedProcessor(publishers, output_path, feed_cache_name) as fp:
+            fp.aggregate()
         shutil.copyfile(
             config.output_feed_path / f"{category}.json-tmp",
             config.output_feed_path / f"{category}.json",
         )
 
         if not config.no_upload:
-            upload_file(
-                config.output_feed_path / f"{category}.json",
-                config.pub_s3_bucket,
-                f"brave-today/{category}{str(config.sources_file).replace('sources', '')}.json",
-            )
-            # Temporarily upload also with incorrect filename as a stopgap for
-            # https://github.com/brave/brave-browser/issues/20114
-            # Can be removed once fixed in the brave-core client for all Desktop users.
-            upload_file(
-                config.output_feed_path / f"{category}.json",
-                config.pub_s3_bucket,
-                f"brave-today/{category}{str(config.sources_file).replace('sources', '')}json",
+            upload_files(
+                [
+                    (
+                        config.output_feed_path / f"{category}.json",
+                        config.pub_s3_bucket,
+                        f"brave-today/{category}{str(config.sources_file).replace('sources', '')}.json",
+                    ),
+                    # Temporarily upload also with incorrect filename as a stopgap for
+                    # https://github.com/brave/brave-browser/issues/20114
+                    # Can be removed once fixed in the brave-core client for all
+                    # Desktop users.
+                    (
+                        config.output_feed_path / f"{category}.json",
+                        config.pub_s3_bucket,
+                        f"brave-today/{category}{str(config.sources_file).replace('sources', '')}json",
+                    ),
+                ]
             )
-    with open(config.output_path / "report.json", "w") as f:
-        f.write(json.dumps(fp.report))
+    with open(config.output_path / "report.json", "wb") as f:
+        f.write(orjson.dumps(fp.report))
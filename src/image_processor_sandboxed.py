@@ -6,56 +6,56 @@
 import hashlib
 import os
 
-import boto3
 import requests
 import structlog
-from fake_useragent import UserAgent
+from botocore.exceptions import BotoCoreError, ClientError
 from wasmer import Instance, Module, Store, engine
 from wasmer_compiler_cranelift import Compiler
 
 from config import get_config
-from utils import ObjectNotFound, upload_file
-
-ua = UserAgent(browsers=["edge", "chrome", "firefox", "safari", "opera"])
+from utils import get_http_session, get_user_agent, s3_client, upload_file
 
 config = get_config()
 
 logger = structlog.getLogger(__name__)
 
-boto_session = boto3.Session()
-s3_client = boto_session.client("s3")
-s3_resource = boto3.resource("s3")
-
 wasm_store = Store(engine.JIT(Compiler))
 wasm_module = Module(wasm_store, open(config.wasm_thumbnail_path, "rb").read())
 instance = Instance(wasm_module)
 
 
-def resize_and_pad_image(image_bytes, width, height, size, cache_path, quality=80):
+def resize_and_pad(image_bytes, width, height, size, quality=80) -> bytes:
+    """Runs the image through the sandboxed resize_and_pad. The input and output
+    buffers are always freed, so a failing image doesn't leak wasm memory."""
     image_length = len(image_bytes)
     input_pointer = instance.exports.allocate(image_length)
-    memory = instance.exports.memory.uint8_view(input_pointer)
-    memory[0:image_length] = image_bytes
-
     try:
+        # Copying through a memoryview is a single memcpy, where uint8_view slices
+        # are copied byte by byte. The view is taken again after each call, as the
+        # module can grow (and so move) its memory.
+        with memoryview(instance.exports.memory.buffer) as memory:
+            memory[input_pointer : input_pointer + image_length] = image_bytes
+
         output_pointer = instance.exports.resize_and_pad(
             input_pointer, image_length, width, height, size, quality
         )
+    finally:
         instance.exports.deallocate(input_pointer, image_length)
 
-        memory = instance.exports.memory.uint8_view(output_pointer)
-        out_bytes = bytes(memory[:size])
-
+    try:
+        with memoryview(instance.exports.memory.buffer) as memory:
+            return bytes(memory[output_pointer : output_pointer + size])
+    finally:
         instance.exports.deallocate(output_pointer, size)
 
-        with open(str(cache_path), "wb+") as out_image:
-            out_image.write(out_bytes)
 
-        return True
+def resize_and_pad_image(image_bytes, width, height, size, cache_path, quality=80):
+    try:
+        out_bytes = resize_and_pad(image_bytes, width, height, size, quality)
     except RuntimeError:
         logger.info(
             "resize_and_pad() hit a RuntimeError (length=%s, width=%s, height=%s, size=%s): %s.failed",
-            image_length,
+            len(image_bytes),
             width,
             height,
             size,
@@ -67,11 +67,16 @@ def resize_and_pad_image(image_bytes, width, height, size, cache_path, quality=8
 
         return False
 
+    with open(str(cache_path), "wb+") as out_image:
+        out_image.write(out_bytes)
+
+    return True
+
 
 def get_with_max_size(url, max_bytes=1000000):
     is_large = False
-    response = requests.get(
-        url, timeout=config.request_timeout, headers={"User-Agent": ua.random}
+    response = get_http_session().get(
+        url, timeout=config.request_timeout, headers={"User-Agent": get_user_agent()}
     )
     response.raise_for_status()
     if (
@@ -90,6 +95,40 @@ class ImageProcessor:
         self.s3_bucket = s3_bucket
         self.s3_path = s3_path
         self.force_upload = force_upload
+        self.uploaded = None
+
+    def preload_s3_index(self):
+        """Lists the images already uploaded under s3_path, so cache_image doesn't
+        need a HEAD request per image. Call it before forking any workers. If the
+        listing fails, each image is checked with a HEAD request instead."""
+        prefix = self.s3_path.format("")
+        uploaded = set()
+        paginator = s3_client.get_paginator("list_objects_v2")
+        try:
+            for page in paginator.paginate(Bucket=self.s3_bucket, Prefix=prefix):
+                for s3_object in page.get("Contents", []):
+                    uploaded.add(s3_object["Key"][len(prefix) :])
+        except (BotoCoreError, ClientError) as e:
+            logger.error(f"Failed to list the images uploaded to {prefix}: {e}")
+            return
+        self.uploaded = uploaded
+        logger.info(f"Found {len(uploaded)} images already uploaded to {prefix}")
+
+    def is_uploaded(self, cache_fn):
+        if self.uploaded is not None:
+            return cache_fn in self.uploaded
+
+        try:
+            s3_client.head_object(
+                Bucket=self.s3_bucket, Key=self.s3_path.format(cache_fn)
+            )
+            return True
+        except ClientError as e:
+            # Anything but a missing object (access denied, throttling, ...) must
+            # not be mistaken for one, or we'd silently upload it again.
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                return False
+            raise
 
     def cache_image(self, url):  # noqa: C901
         content = None
@@ -101,24 +140,21 @@ class ImageProcessor:
             if not is_large and not self.force_upload:
                 return url
 
-            cache_fn = f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.jpg.pad"
+            # Only used to name the file, so it doesn't need a cryptographic hash.
+            url_digest = hashlib.blake2b(url.encode("utf-8"), digest_size=16)
+            cache_fn = f"{url_digest.hexdigest()}.jpg.pad"
             cache_path = config.img_cache_path / cache_fn
 
             # if we have it don't do it again
             if os.path.isfile(cache_path):
                 return cache_fn
             # also check if we have it on s3
-            if not config.no_upload:
-                try:
-                    s3_resource.Object(
-                        self.s3_bucket, self.s3_path.format(cache_fn)
-                    ).load()
-                    exists = True
-                except ObjectNotFound:
-                    exists = False
-                if exists:
-                    return cache_fn
+            if not config.no_upload and self.is_uploaded(cache_fn):
+                return cache_fn
 
+        except ClientError as e:
+            logger.error(f"Failed to check if {url} is already uploaded: {e}")
+            return None
         except requests.exceptions.ReadTimeout as e:
             logger.info(f"Image is not already uploaded {url} with {e}")
         except ValueError as e:
@@ -3,32 +3,126 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at https://mozilla.org/MPL/2.0/. */
 
+import asyncio
+import csv
+import itertools
 import logging
 import mimetypes
+import mmap
+import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from urllib.parse import urlparse
 
+import aiohttp
 import boto3
 import orjson
+import requests
 import structlog
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
 from botocore.exceptions import ClientError
+from fake_useragent import UserAgent
 from prometheus_client import push_to_gateway
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import config
 
 boto_session = boto3.Session()
-s3_client = boto_session.client("s3")
-
-domain_url_fixer = re.compile(r"^https://(www\.)?|^")
-subst = "https://www."
+# Shared by the upload threads, so give it a connection for each of them.
+s3_client = boto_session.client("s3", config=BotoConfig(max_pool_connections=64))
+# The lookups and feeds are a few MB at most, so upload them in a single request
+# and read them from disk in larger chunks than the 256 KB default.
+transfer_config = TransferConfig(
+    multipart_threshold=64 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    io_chunksize=1024 * 1024,
+)
+
+scheme_prefix = "https://www."
+
+# An https scheme followed by a non-empty host, i.e. what urlparse would give a
+# scheme of "https" and a netloc for.
+https_url_re = re.compile(r"^https://[^/?#]", re.IGNORECASE)
+
+# Content types of the files we upload, so upload_file rarely needs mimetypes.
+# The padded images (*.jpg.pad) are served as opaque bytes.
+content_types = {
+    ".gz": "application/gzip",
+    ".json": "application/json",
+    ".pad": "binary/octet-stream",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".xml": "application/xml",
+}
 
 config = config.get_config()
 
+# The grants given to uploads, by bucket. These are also the only buckets we
+# download from. If both buckets are the same, the public grants win.
+bucket_grants = {
+    config.private_s3_bucket: {
+        "GrantRead": "id=%s" % config.private_cdn_canonical_id,
+        "GrantFullControl": "id=%s" % config.private_cdn_cloudfront_canonical_id,
+    },
+}
+bucket_grants[config.pub_s3_bucket] = {
+    "GrantRead": "id=%s" % config.brave_today_cloudfront_canonical_id,
+    "GrantFullControl": "id=%s" % config.brave_today_canonical_id,
+}
+
 logger = structlog.getLogger(__name__)
 
 
+ua = UserAgent(browsers=["edge", "chrome", "firefox", "safari", "opera"])
+# ua.random samples fake_useragent's data on every call, so draw a few up front
+# and rotate through them instead.
+user_agents = itertools.cycle([ua.random for _ in range(32)])
+
+
+def get_user_agent() -> str:
+    return next(user_agents)
+
+
+http_sessions = threading.local()
+
+
+def reset_http_sessions():
+    global http_sessions
+    http_sessions = threading.local()
+
+
+# Forked pool workers must not reuse the parent's pooled connections.
+os.register_at_fork(after_in_child=reset_http_sessions)
+
+
+def get_http_session() -> requests.Session:
+    """Returns this thread's requests session, so requests to the same host reuse
+    keep-alive connections. Failed requests with a 5xx status are retried twice."""
+    session = getattr(http_sessions, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=64,
+            pool_maxsize=64,
+            max_retries=Retry(
+                total=2,
+                backoff_factor=0.3,
+                status_forcelist=(500, 502, 503, 504),
+                raise_on_status=False,
+            ),
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        http_sessions.session = session
+    return session
+
+
 class InvalidS3Bucket(Exception):
     pass
 
@@ -41,50 +135,44 @@ def upload_file(file_name: Path, bucket: str, object_name: Optional[str] = None)
     if object_name is None:
         object_name = file_name
     try:
-        content_type = mimetypes.guess_type(file_name)[0] or "binary/octet-stream"
-        if bucket == config.pub_s3_bucket:
-            s3_client.upload_file(
-                file_name,
-                bucket,
-                object_name,
-                ExtraArgs={
-                    "GrantRead": "id=%s" % config.brave_today_cloudfront_canonical_id,
-                    "GrantFullControl": "id=%s" % config.brave_today_canonical_id,
-                    "ContentType": content_type,
-                },
-            )
-        elif bucket == config.private_s3_bucket:
-            s3_client.upload_file(
-                file_name,
-                bucket,
-                object_name,
-                ExtraArgs={
-                    "GrantRead": "id=%s" % config.private_cdn_canonical_id,
-                    "GrantFullControl": "id=%s"
-                    % config.private_cdn_cloudfront_canonical_id,
-                    "ContentType": content_type,
-                },
-            )
-        else:
+        content_type = content_types.get(Path(file_name).suffix.lower())
+        if content_type is None:
+            content_type = mimetypes.guess_type(file_name)[0] or "binary/octet-stream"
+
+        grants = bucket_grants.get(bucket)
+        if grants is None:
             raise InvalidS3Bucket("Attempted to upload to unknown S3 bucket.")
 
+        s3_client.upload_file(
+            file_name,
+            bucket,
+            object_name,
+            Config=transfer_config,
+            ExtraArgs={**grants, "ContentType": content_type},
+        )
+
     except ClientError as e:
         logging.error(e)
         return False
     return True
 
 
+def upload_files(uploads: List[Tuple[Path, str, str]]) -> bool:
+    """Uploads every (file_name, bucket, object_name) in parallel. Returns whether
+    all of them succeeded."""
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        return all(executor.map(lambda upload: upload_file(*upload), uploads))
+
+
 def download_file(file_name: str, bucket: str, object_name: Optional[str] = None):
     if object_name is None:
         object_name = file_name
 
     try:
-        if bucket == config.pub_s3_bucket:
-            s3_client.download_file(bucket, object_name, file_name)
-        elif bucket == config.private_s3_bucket:
-            s3_client.download_file(bucket, object_name, file_name)
-        else:
-            raise InvalidS3Bucket("Attempted to upload to unknown S3 bucket.")
+        if bucket not in bucket_grants:
+            raise InvalidS3Bucket("Attempted to download from unknown S3 bucket.")
+
+        s3_client.download_file(bucket, object_name, file_name, Config=transfer_config)
 
     except ClientError as e:
         logging.error(e)
@@ -92,31 +180,66 @@ def download_file(file_name: str, bucket: str, object_name: Optional[str] = None
     return True
 
 
+def load_json_from_s3(bucket: str, object_name: str) -> Optional[Any]:
+    """Fetch and parse a JSON object from S3 without writing it to disk first.
+    Returns None if the object can't be fetched."""
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=object_name)
+        return orjson.loads(response["Body"].read())
+    except ClientError as e:
+        logging.error(e)
+        return None
+
+
+def load_json_file(path: Path) -> Any:
+    """Parses a JSON file straight out of a memory map, without first copying it
+    into a bytes object."""
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                return orjson.loads(view)
+
+
 def ensure_scheme(domain):
     """Helper utility for ensuring a domain has a scheme. If none is attached
     this will use the https scheme.
 
-    Note: this will break if domain has a non http(s) scheme.
+    Note: this will break if domain has a non https scheme.
     example.com ==> https://www.example.com
     https://example.com ==> https://www.example.com
-    file://example.com ==> https://file://example.com
+    https://www.example.com ==> https://www.example.com
+    file://example.com ==> https://www.file://example.com
     """
-    return domain_url_fixer.sub(subst, domain, 1)
+    if domain.startswith(scheme_prefix):
+        return domain
+    if domain.startswith("https://"):
+        return scheme_prefix + domain[len("https://") :]
+    return scheme_prefix + domain
 
 
-def get_all_domains() -> List[str]:
-    """Helper utility for getting all domains across all sources"""
+def get_all_domains() -> Iterator[str]:
+    """Helper utility for getting all domains across all sources. Each domain is
+    only yielded once, even if several sources list it."""
+    seen = set()
     source_files = list(config.sources_dir.glob("sources.*_*.csv"))
     for source_file in source_files:
-        with open(source_file) as f:
+        # A large read buffer keeps the number of read() calls down on the
+        # bigger source lists.
+        with open(source_file, newline="", buffering=1 << 20) as f:
             # Skip the first line, with the headers.
-            lines = f.readlines()[1:]
+            next(f, None)
 
             # The domain is the first field on the line
-            yield from [line.split(",")[0].strip() for line in lines]
+            for row in csv.reader(f):
+                if not row:
+                    continue
+                domain = row[0].strip()
+                if domain not in seen:
+                    seen.add(domain)
+                    yield domain
 
 
-def uri_validator(x):
+def uri_validator(x, strict: bool = False):
     """
     'http://www.cwi.nl:80/%7Eguido/Python.html' False
     '/data/Python.html' False
@@ -125,56 +248,107 @@ def uri_validator(x):
     'https://stackoverflow.com' True
 
     :param x: URL
+    :param strict: parse the whole URL with urlparse instead of just checking the
+        prefix
     :return: bool
     """
     try:
+        if not strict:
+            return https_url_re.match(x) is not None
+
         result = urlparse(x)
         return all([result.scheme, result.scheme == "https", result.netloc])
     except Exception:
         return False
 
 
+@lru_cache()
 def get_favicons_lookup() -> Dict[Any, Any]:
     if not config.no_download:
-        download_file(
-            str(config.output_path / config.favicon_lookup_file),
-            config.pub_s3_bucket,
-            str(config.favicon_lookup_file),
+        favicons_lookup = load_json_from_s3(
+            config.pub_s3_bucket, str(config.favicon_lookup_file)
         )
+        if favicons_lookup is not None:
+            return favicons_lookup
 
     if Path(config.output_path / config.favicon_lookup_file).is_file():
-        with open(config.output_path / config.favicon_lookup_file) as f:
-            favicons_lookup = orjson.loads(f.read())
-            return favicons_lookup
+        return load_json_file(config.output_path / config.favicon_lookup_file)
     else:
         return {}
 
 
+@lru_cache()
 def get_cover_infos_lookup() -> Dict[Any, Any]:
     if not config.no_download:
-        download_file(
-            str(config.output_path / config.cover_info_lookup_file),
-            config.pub_s3_bucket,
-            str(config.cover_info_lookup_file),
+        cover_infos_lookup = load_json_from_s3(
+            config.pub_s3_bucket, str(config.cover_info_lookup_file)
         )
+        if cover_infos_lookup is not None:
+            return cover_infos_lookup
 
     if Path(config.output_path / config.cover_info_lookup_file).is_file():
-        with open(config.output_path / config.cover_info_lookup_file) as f:
-            cover_infos_lookup = orjson.loads(f.read())
-            return cover_infos_lookup
+        return load_json_file(config.output_path / config.cover_info_lookup_file)
     else:
         return {}
 
 
 def push_metrics_to_pushgateway(metric, metric_value, label_value, registry):
+    """Records the metric value. The registry is only sent to the Pushgateway by
+    flush_metrics, so a run makes one request however many metrics it records."""
     try:
         # Set the metric value
         metric.labels(url=label_value).inc(metric_value)
 
-        # Push the metrics to the Pushgateway
+    except Exception as e:
+        logger.error(f"Failed to record metrics: {e}")
+
+
+def flush_metrics(registry):
+    """Pushes every metric in the registry to the Pushgateway in one request."""
+    if not config.prom_pushgateway_url:
+        return
+
+    try:
         push_to_gateway(
             config.prom_pushgateway_url, job="news-aggregator", registry=registry
         )
 
     except Exception as e:
         logger.error(f"Failed to push metrics: {e}")
+
+
+def get_chunksize(jobs) -> int:
+    """Around four chunks per worker, fewer round-trips without starving any."""
+    return max(1, len(jobs) // (config.concurrency * 4))
+
+
+async def gather_with_session(fn, items, *args, timeout: Optional[float] = None):
+    """Runs fn(session, item, *args) for every item on one shared aiohttp
+    session, with at most config.async_concurrency requests in flight. Requests
+    time out when connecting, or waiting on a read, takes longer than
+    config.request_timeout, unless another timeout is given.
+
+    There is no total timeout, since aiohttp would count the time spent waiting
+    for a free connection to a busy host against it."""
+    semaphore = asyncio.Semaphore(config.async_concurrency)
+    # Hundreds of sites share a handful of hosts, so cache the DNS lookups and
+    # don't hammer any one host with all the connections.
+    connector = aiohttp.TCPConnector(
+        limit=config.async_concurrency,
+        limit_per_host=config.async_concurrency_per_host,
+        ttl_dns_cache=300,
+    )
+    seconds = timeout or config.request_timeout
+    client_timeout = aiohttp.ClientTimeout(
+        total=None, sock_connect=seconds, sock_read=seconds
+    )
+
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=client_timeout
+    ) as session:
+
+        async def bounded(item):
+            async with semaphore:
+                return await fn(session, item, *args)
+
+        return await asyncio.gather(*[bounded(item) for item in items])
@@ -3,47 +3,118 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at https://mozilla.org/MPL/2.0/. */
 
+import asyncio
 import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 
+import aiohttp
+import bleach
 import feedparser
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from better_profanity import profanity
+from botocore.exceptions import NoCredentialsError
+from PIL import Image
 
+import image_processor_sandboxed
 from config import get_config
-from feed_processor_multi import score_entries, scrub_html
+from favicons_covers import cover_images, update_favicon_urls
+from favicons_covers.cover_images import get_background_color
+from feed_processor_multi import contains_profanity, score_entries, scrub_html
+from models.base import clean_str
 from src import feed_processor_multi
 
 config = get_config()
 
 
-def test_feed_processor_download():
-    result = feed_processor_multi.download_feed("https://brave.com/blog/index.xml")
-    assert result
+def test_feed_processor_download(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "output_path", tmp_path)
+    monkeypatch.setattr(config, "no_download", True)
+    monkeypatch.setattr(config, "no_upload", True)
+    validators_sent = []
+
+    async def feed(request):
+        validators_sent.append(request.headers.get("If-None-Match"))
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304)
+        return web.Response(body=b"<rss>v1</rss>", headers={"ETag": '"v1"'})
+
+    async def large_feed(request):
+        return web.Response(body=b"x" * 1000)
+
+    async def download_feeds():
+        app = web.Application()
+        app.router.add_get("/feed.xml", feed)
+        app.router.add_get("/large.xml", large_feed)
+        async with TestServer(app) as server, aiohttp.ClientSession() as session:
+            url = str(server.make_url("/feed.xml"))
+            first = await feed_processor_multi.download_feed_async(session, url)
+            # As the next run would see it.
+            feed_processor_multi.save_feed_cache("feed_cache.json.gz", [first])
+            cached_feeds = feed_processor_multi.load_feed_cache("feed_cache.json.gz")
+            second = await feed_processor_multi.download_feed_async(
+                session, url, cached_feeds
+            )
+            large = await feed_processor_multi.download_feed_async(
+                session, str(server.make_url("/large.xml")), max_feed_size=100
+            )
+        return url, first, second, large
+
+    url, first, second, large = asyncio.run(download_feeds())
+    assert first == {
+        "feed_cache": b"<rss>v1</rss>",
+        "key": url,
+        "validators": {"If-None-Match": '"v1"'},
+    }
+    # The ETag was stored, and the 304 reused the cached body.
+    assert validators_sent == [None, '"v1"']
+    assert second == first
+    # Over the size limit.
+    assert large is None
+
+
+def test_feed_cache_errors_are_not_fatal(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "output_path", tmp_path / "missing")
+    monkeypatch.setattr(config, "no_download", True)
+    monkeypatch.setattr(config, "no_upload", True)
+
+    downloaded = {"feed_cache": b"<rss/>", "key": "https://a.com", "validators": {}}
+    feed_processor_multi.save_feed_cache("feed_cache.json.gz", [downloaded])
+    assert feed_processor_multi.load_feed_cache("feed_cache.json.gz") == {}
+
+    monkeypatch.setattr(config, "output_path", tmp_path)
+    (tmp_path / "feed_cache.json.gz").write_bytes(b"not gzip")
+    assert feed_processor_multi.load_feed_cache("feed_cache.json.gz") == {}
 
 
 def test_feed_processor_aggregate():
     feeds = json.loads(open(config.tests_dir / "test.json").read())
-    fp = feed_processor_multi.FeedProcessor(
+    with feed_processor_multi.FeedProcessor(
         feeds, config.output_feed_path / "test.json"
-    )
-    fp.aggregate()
-    assert os.stat(config.output_feed_path / "test.json").st_size != 0
+    ) as fp:
+        fp.aggregate()
+        assert os.stat(config.output_feed_path / "test.json").st_size != 0
 
-    with open(config.output_feed_path / "test.json") as f:
-        data = json.loads(f.read())
-    assert data
-    assert len(data) != 0
+        with open(config.output_feed_path / "test.json") as f:
+            data = json.loads(f.read())
+        assert data
+        assert len(data) != 0
 
 
 def test_check_images():
     feeds = json.loads(open(config.tests_dir / "test.json").read())
-    fp = feed_processor_multi.FeedProcessor(
+    with feed_processor_multi.FeedProcessor(
         feeds, config.output_feed_path / "test.json"
-    )
-    data = [feedparser.parse(config.tests_dir / "test.rss")["items"][0]]
-    data[0]["img"] = data[0]["media_content"][0]["url"]
-    data[0]["publisher_id"] = ""
-    fp.feeds[""] = {"og_images": False}
-    assert fp.check_images(data)
+    ) as fp:
+        data = [feedparser.parse(config.tests_dir / "test.rss")["items"][0]]
+        data[0]["img"] = data[0]["media_content"][0]["url"]
+        data[0]["publisher_id"] = ""
+        fp.feeds[""] = {"og_images": False}
+        assert fp.check_images(data)
 
 
 def test_download_feeds():
@@ -52,10 +123,12 @@ def test_download_feeds():
     data = {
         "https://brave.com/blog/index.xml": data["https://brave.com/blog/index.xml"]
     }
-    fp = feed_processor_multi.FeedProcessor(data, config.output_feed_path / "test.json")
-    fp.report["feed_stats"] = {}
-    result = fp.download_feeds()
-    assert len(result) != 0
+    with feed_processor_multi.FeedProcessor(
+        data, config.output_feed_path / "test.json"
+    ) as fp:
+        fp.report["feed_stats"] = {}
+        result = fp.download_feeds()
+        assert len(result) != 0
 
 
 def test_get_rss():
@@ -64,10 +137,12 @@ def test_get_rss():
     data = {
         "https://brave.com/blog/index.xml": data["https://brave.com/blog/index.xml"]
     }
-    fp = feed_processor_multi.FeedProcessor(data, config.output_feed_path / "test.json")
-    fp.report["feed_stats"] = {}
-    result = fp.get_rss()
-    assert len(result) != 0
+    with feed_processor_multi.FeedProcessor(
+        data, config.output_feed_path / "test.json"
+    ) as fp:
+        fp.report["feed_stats"] = {}
+        result = fp.get_rss()
+        assert len(result) != 0
 
 
 def test_fixup_entries():
@@ -76,15 +151,17 @@ def test_fixup_entries():
     data = {
         "https://brave.com/blog/index.xml": data["https://brave.com/blog/index.xml"]
     }
-    fp = feed_processor_multi.FeedProcessor(data, config.output_feed_path / "test.json")
-    fp.report["feed_stats"] = {}
-    entries = fp.get_rss()
-    assert len(entries) != 0
+    with feed_processor_multi.FeedProcessor(
+        data, config.output_feed_path / "test.json"
+    ) as fp:
+        fp.report["feed_stats"] = {}
+        entries = fp.get_rss()
+        assert len(entries) != 0
 
-    sorted_entries = sorted(entries, key=lambda entry: entry["publish_time"])
-    sorted_entries.reverse()  # for most recent entries first
+        sorted_entries = sorted(entries, key=lambda entry: entry["publish_time"])
+        sorted_entries.reverse()  # for most recent entries first
 
-    assert sorted_entries
+        assert sorted_entries
 
 
 def test_scrub_html():
@@ -93,17 +170,19 @@ def test_scrub_html():
     data = {
         "https://brave.com/blog/index.xml": data["https://brave.com/blog/index.xml"]
     }
-    fp = feed_processor_multi.FeedProcessor(data, config.output_feed_path / "test.json")
-    fp.report["feed_stats"] = {}
-    entries = fp.get_rss()
-    assert len(entries) != 0
+    with feed_processor_multi.FeedProcessor(
+        data, config.output_feed_path / "test.json"
+    ) as fp:
+        fp.report["feed_stats"] = {}
+        entries = fp.get_rss()
+        assert len(entries) != 0
 
-    sorted_entries = sorted(entries, key=lambda entry: entry["publish_time"])
-    sorted_entries.reverse()  # for most recent entries first
+        sorted_entries = sorted(entries, key=lambda entry: entry["publish_time"])
+        sorted_entries.reverse()  # for most recent entries first
 
-    filtered_entries = [scrub_html(i) for i in sorted_entries]
+        filtered_entries = [scrub_html(i) for i in sorted_entries]
 
-    assert filtered_entries
+        assert filtered_entries
 
 
 def test_score_entries():
@@ -112,15 +191,389 @@ def test_score_entries():
     data = {
         "https://brave.com/blog/index.xml": data["https://brave.com/blog/index.xml"]
     }
-    fp = feed_processor_multi.FeedProcessor(data, config.output_feed_path / "test.json")
-    fp.report["feed_stats"] = {}
-    entries = fp.get_rss()
-    assert len(entries) != 0
+    with feed_processor_multi.FeedProcessor(
+        data, config.output_feed_path / "test.json"
+    ) as fp:
+        fp.report["feed_stats"] = {}
+        entries = fp.get_rss()
+        assert len(entries) != 0
+
+        sorted_entries = sorted(entries, key=lambda entry: entry["publish_time"])
+        sorted_entries.reverse()  # for most recent entries first
+
+        filtered_entries = [scrub_html(i) for i in sorted_entries]
+        filtered_entries = score_entries(filtered_entries)
+
+        assert filtered_entries
+
+
+def test_score_entries_without_timestamps():
+    entries = [
+        {
+            "publish_time": "2023-05-02 10:00:00",
+            "publisher_id": "a",
+            "_ts": 1683021600.0,
+        },
+        {"publish_time": "2023-05-01 10:00:00", "publisher_id": "a"},
+        {"publish_time": "2023-05-01 09:00:00", "publisher_id": "b"},
+    ]
+    scores = [entry["score"] for entry in score_entries(entries)]
+    assert all("_ts" not in entry for entry in entries)
+    # The second entry of a publisher scores double, so it comes out ahead.
+    assert scores[1] > scores[2] > scores[0]
+
+    # Scoring the same entries again parses their publish_time.
+    rescored = [entry["score"] for entry in score_entries(entries)]
+    assert rescored == pytest.approx(scores, rel=1e-6)
+
+
+def test_get_background_color():
+    image = Image.new("RGBA", (32, 32), (0, 0, 0, 0))
+    image.paste((255, 0, 0, 255), (8, 8, 24, 24))
+    assert get_background_color(image) == "#ff0000"
+
+    assert get_background_color(Image.new("RGBA", (8, 8), (0, 0, 0, 0))) is None
+
+    # Red, green and blue are all the same length, so the median is picked
+    # among them in edge order, as with a stable sort.
+    red, green, blue = (255, 0, 0, 255), (0, 255, 0, 255), (0, 0, 255, 255)
+    black, white = (10, 10, 10, 255), (250, 250, 250, 255)
+    image = Image.new("RGBA", (3, 3))
+    image.putdata([blue, blue, black, white, red, red, white, white, green])
+    colors = [tuple(color.tolist()) for color in cover_images.get_edge_colors(image)]
+    middle = sorted(colors, key=lambda color: sum(c * c for c in color[:3]))[
+        len(colors) // 2
+    ]
+    assert get_background_color(image) == "#%02x%02x%02x" % middle[:3]
+
+
+def test_get_icon_resizes_any_mode(monkeypatch, tmp_path):
+    monkeypatch.setattr(cover_images, "CACHE_FOLDER", tmp_path)
+    # A 16 bit TIFF opens as I;16, which can't be resized as is.
+    url = "https://example.com/deep.tiff"
+    Image.new("I;16", (512, 512), 1000).save(cover_images.get_filename(url), "TIFF")
+
+    image = cover_images.get_icon(url)
+    assert image.mode == "RGBA"
+    assert image.size == cover_images.ICON_SIZE
+    assert image.info["source_size"] == (512, 512)
+
+
+def test_get_favicon_falls_back_when_lookup_fails(monkeypatch):
+    class FailingSession:
+        def get(self, *args, **kwargs):
+            raise aiohttp.ClientError("lookup failed")
+
+    monkeypatch.setattr(
+        update_favicon_urls,
+        "get_fallback_favicon",
+        lambda domain: f"{domain}/icon.png",
+    )
+    with ThreadPoolExecutor(1) as executor:
+        result = asyncio.run(
+            update_favicon_urls.get_favicon(
+                FailingSession(), "https://example.com", executor
+            )
+        )
+    assert result == ("https://example.com", "https://example.com/icon.png")
+
+
+def fail_metadata_parser(*args, **kwargs):
+    raise Exception("metadata_parser is not used here")
+
+
+def test_get_fallback_favicon_uses_icon_link(monkeypatch):
+    def get_page_head(domain, byte_range=None):
+        # A cut-off range with no icon link, then the full head.
+        if byte_range:
+            return b"<html><head><title>Example</title>", True
+        return b'<html><head><link rel="icon" href="/x.png">', False
+
+    monkeypatch.setattr(update_favicon_urls, "probe_default_favicon", lambda d: None)
+    monkeypatch.setattr(
+        update_favicon_urls.metadata_parser, "MetadataParser", fail_metadata_parser
+    )
+    monkeypatch.setattr(update_favicon_urls, "get_page_head", get_page_head)
+
+    assert (
+        update_favicon_urls.get_fallback_favicon("https://example.com")
+        == "https://example.com/x.png"
+    )
+
+
+def test_get_fallback_favicon_prefers_icon_over_apple_touch_icon(monkeypatch):
+    head = (
+        b"<html><head>"
+        b'<link rel="apple-touch-icon" href="/apple.png">'
+        b'<link rel="stylesheet" href="/style.css">'
+        b'<link rel="shortcut icon" href="/shortcut.ico">'
+    )
+    monkeypatch.setattr(update_favicon_urls, "probe_default_favicon", lambda d: None)
+    monkeypatch.setattr(
+        update_favicon_urls.metadata_parser, "MetadataParser", fail_metadata_parser
+    )
+    monkeypatch.setattr(
+        update_favicon_urls, "get_page_head", lambda d, byte_range=None: (head, False)
+    )
+
+    assert (
+        update_favicon_urls.get_fallback_favicon("https://example.com")
+        == "https://example.com/shortcut.ico"
+    )
+    assert update_favicon_urls.find_icon_links(b"  ") == []
+
+
+def test_get_page_head_stops_at_head_end(monkeypatch):
+    def full_head():
+        # The closing tag straddles two chunks, and the body is never read.
+        yield b"<html><head><title>Example</title></he"
+        yield b"ad><body>"
+        raise AssertionError("read past </head>")
+
+    def cut_off_head():
+        yield b"<html><head><title>Example</title>"
 
-    sorted_entries = sorted(entries, key=lambda entry: entry["publish_time"])
-    sorted_entries.reverse()  # for most recent entries first
+    bodies = [full_head(), cut_off_head()]
 
-    filtered_entries = [scrub_html(i) for i in sorted_entries]
-    filtered_entries = score_entries(filtered_entries)
+    class Response:
+        status_code = 206
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def iter_content(self, chunk_size):
+            return bodies.pop(0)
+
+    class Session:
+        def get(self, url, timeout, headers, stream):
+            assert headers["Range"] == "bytes=0-16383"
+            assert stream
+            return Response()
+
+    monkeypatch.setattr(update_favicon_urls, "get_http_session", Session)
+
+    # The whole head was read, so there's no need for the rest of the page.
+    content, partial = update_favicon_urls.get_page_head(
+        "https://example.com", byte_range="bytes=0-16383"
+    )
+    assert content == b"<html><head><title>Example</title>"
+    assert not partial
+
+    content, partial = update_favicon_urls.get_page_head(
+        "https://example.com", byte_range="bytes=0-16383"
+    )
+    assert content == b"<html><head><title>Example</title>"
+    assert partial
+
+
+def test_get_html_parser_is_per_thread():
+    parser = update_favicon_urls.get_html_parser()
+    assert update_favicon_urls.get_html_parser() is parser
+
+    other_thread_parsers = []
+
+    def get_other_thread_parser():
+        other_thread_parsers.append(update_favicon_urls.get_html_parser())
+
+    thread = threading.Thread(target=get_other_thread_parser)
+    thread.start()
+    thread.join()
+    assert other_thread_parsers[0] is not parser
+
+    # Comments are dropped, and the parser is reusable across documents.
+    for _ in range(2):
+        links = update_favicon_urls.find_icon_links(
+            b'<head><!-- <link rel="icon" href="/old.ico"> -->'
+            b'<link rel="icon" href="/new.ico">'
+        )
+        assert [link.get("href") for link in links] == ["/new.ico"]
+
+
+def test_clean_str_matches_bleach():
+    texts = [
+        "Tom\xa0& Jerry",
+        "1 < 2 & 3 > 2",
+        "AT&amp;T\xa0<b>news</b>",
+        '<a href="https://brave.com" onclick="x()">Brave</a>\xa0',
+        "<div>Title</div><script>alert(1)</script><style>p {}</style>",
+        "<p>x</p><p>y</p>",
+        "<p>x</p>\n<p>y</p>",
+        " <DIV class='a'>x</DIV>",
+        "<h1>Title</h1>text<hr/>more",
+        "<ul><li>a</li><li>b</li></ul>",
+        "x<br>y",
+        "&lt;b&gt;",
+        "x<p>y",
+        "x</p><p>y",
+        "<!-- c --><p>y",
+        "<b>b</b> <p>y</p>",
+    ]
+    for text in texts:
+        expected = bleach.clean(text, strip=True).replace("&amp;", "&")
+        assert clean_str(text) == expected, text
+
+    # Unlike bleach, character references are decoded.
+    assert clean_str("&copy; it&#39;s &quot;q&quot;") == '© it\'s "q"'
+    assert clean_str("a&nbsp;b") == "a\xa0b"
+
+
+def test_get_best_image_ranks_by_source_size(monkeypatch, tmp_path):
+    monkeypatch.setattr(cover_images, "CACHE_FOLDER", tmp_path)
+    urls = ["https://example.com/small.png", "https://example.com/big.png"]
+    for url, size in zip(urls, [300, 1024]):
+        image = Image.new("RGBA", (size, size), (255, 0, 0, 255))
+        image.save(cover_images.get_filename(url), "PNG")
+    monkeypatch.setattr(cover_images, "get_soup", lambda site_url: True)
+    monkeypatch.setattr(
+        cover_images, "get_manifest_icon_urls", lambda site_url, soup: urls
+    )
+
+    # The second pass reads the icons back from the decoded cache.
+    for _ in range(2):
+        image, url = cover_images.get_best_image("https://example.com")
+        assert url == urls[1]
+        assert image.size == cover_images.ICON_SIZE
+        assert image.info["source_size"] == (1024, 1024)
+
+
+def test_parse_failures_are_counted_in_the_main_process(monkeypatch):
+    feed_url = "https://example.com/feed.xml"
+
+    async def download_feed_async(session, feed, cached_feeds):
+        return {
+            "feed_cache": b"<rss><channel></channel></rss>",
+            "key": feed,
+            "validators": None,
+        }
+
+    monkeypatch.setattr(
+        feed_processor_multi, "download_feed_async", download_feed_async
+    )
+    registry = feed_processor_multi.registry
+    labels = {"url": "example_com"}
+    before = registry.get_sample_value("publisher_articles_count", labels) or 0
+    with feed_processor_multi.FeedProcessor(
+        {feed_url: {"feed_url": feed_url, "publisher_id": ""}},
+        config.output_feed_path / "test.json",
+    ) as fp:
+        fp.report["feed_stats"] = {}
+        # A plain process pool, so the feed is still parsed in another process.
+        fp._pool = Pool(1)
+        assert fp.download_feeds() == {}
+    assert registry.get_sample_value("publisher_articles_count", labels) == before + 1
+
+
+def test_contains_profanity_matches_better_profanity():
+    texts = ["class", "A classic pass", "Assistant", "中文", "", "a", "Puppies!"]
+    for censor_word in profanity.CENSOR_WORDSET:
+        word = str(censor_word)
+        half = len(word) // 2
+        texts += [
+            word,
+            word.upper(),
+            f"The {word} news",
+            f"{word}s",
+            f"x{word}",
+            # Split across adjacent words.
+            f"{word[:half]} {word[half:]}",
+            f"{word[:half]}-{word[half:]}",
+            # Next to characters better_profanity treats as separators.
+            f"中{word}中",
+            f"{word}。",
+        ]
+
+    for text in texts:
+        assert contains_profanity(text) == profanity.contains_profanity(text), text
+
+
+def test_parse_rss_resolves_relative_links():
+    data = (
+        b'<rss version="2.0"><channel xml:base="https://example.com/news/">'
+        b"<title>Example</title><item><title>Article</title>"
+        b"<link>https://example.com/news/article</link>"
+        b'<description>&lt;img src="../img.png"&gt;</description>'
+        b"</item></channel></rss>"
+    )
+    result = feed_processor_multi.parse_rss(
+        {"key": "https://example.com/feed.xml", "feed_cache": data}
+    )
+    entry = result["feed_cache"]["entries"][0]
+    assert '<img src="https://example.com/img.png" />' in entry["summary"]
+
+
+def test_check_images_in_item_only_reads_html(monkeypatch):
+    parsed_urls = []
+    parse_metadata = feed_processor_multi.parse_metadata
+
+    def record_parse_metadata(url, page_html):
+        parsed_urls.append(url)
+        return parse_metadata(url, page_html)
+
+    monkeypatch.setattr(feed_processor_multi, "parse_metadata", record_parse_metadata)
+    og_image = '<meta property="og:image" content="https://example.com/og.jpg">'
+
+    async def page(request):
+        return web.Response(
+            text=f"<html><head>{og_image}</head></html>", content_type="text/html"
+        )
+
+    async def pdf(request):
+        return web.Response(body=b"%PDF-1.4", content_type="application/pdf")
+
+    async def large_page(request):
+        return web.Response(text="x" * 1000, content_type="text/html")
+
+    async def check_images():
+        app = web.Application()
+        app.router.add_get("/page.html", page)
+        app.router.add_get("/file.pdf", pdf)
+        app.router.add_get("/large.html", large_page)
+        publishers = {"publisher": {"og_images": False}}
+        async with TestServer(app) as server, aiohttp.ClientSession() as session:
+            articles = [
+                await feed_processor_multi.check_images_in_item(
+                    session,
+                    {
+                        "img": "",
+                        "url": str(server.make_url(path)),
+                        "publisher_id": "publisher",
+                    },
+                    publishers,
+                )
+                for path in ("/page.html", "/file.pdf")
+            ]
+            with pytest.raises(ValueError):
+                await feed_processor_multi.get_page_html(
+                    session, str(server.make_url("/large.html")), max_bytes=100
+                )
+        return articles
+
+    page_article, pdf_article = asyncio.run(check_images())
+    assert page_article["img"] == "https://example.com/og.jpg"
+    # The PDF was never handed to the parser.
+    assert pdf_article["img"] == ""
+    assert parsed_urls == [page_article["url"]]
+
+
+def test_preload_s3_index_falls_back_to_head_requests(monkeypatch):
+    class FailingPaginator:
+        def paginate(self, **kwargs):
+            raise NoCredentialsError()
+
+    head_requests = []
+    s3_client = image_processor_sandboxed.s3_client
+    monkeypatch.setattr(s3_client, "get_paginator", lambda name: FailingPaginator())
+    monkeypatch.setattr(
+        s3_client, "head_object", lambda **kwargs: head_requests.append(kwargs)
+    )
 
-    assert filtered_entries
+    im_proc = image_processor_sandboxed.ImageProcessor("bucket")
+    im_proc.preload_s3_index()
+    assert im_proc.uploaded is None
+    assert im_proc.is_uploaded("image.jpg.pad")
+    assert head_requests == [
+        {"Bucket": "bucket", "Key": "brave-today/cache/image.jpg.pad"}
+    ]